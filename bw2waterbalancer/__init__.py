@@ -1,6 +1,12 @@
 __all__ = [
     'ActivityWaterBalancer',
     'DatabaseWaterBalancer',
+    'InMemoryPresamplesLoader',
+    'MatrixIndices',
+    'MultiDatabaseWaterBalancer',
+    'WaterIncidenceMatrix',
+    'WaterKeyIndex',
+    'WaterSampleRecipe',
 ]
 
 
@@ -8,3 +14,9 @@ __version__ = (0, 0, 1)
 
 from .database_water_balancer import DatabaseWaterBalancer
 from .activity_water_balancer import ActivityWaterBalancer
+from .in_memory_presamples import InMemoryPresamplesLoader
+from .matrix_indices import MatrixIndices
+from .multi_database_water_balancer import MultiDatabaseWaterBalancer
+from .water_incidence_matrix import WaterIncidenceMatrix
+from .water_key_index import WaterKeyIndex
+from .water_sample_recipe import WaterSampleRecipe
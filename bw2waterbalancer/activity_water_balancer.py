@@ -1,10 +1,17 @@
 from brightway2 import *
-import warnings
 from .utils import ParameterNameGenerator
 from presamples.models.parameterized import ParameterizedBrightwayModel as PBM
+from presamples import split_inventory_presamples
+from stats_arrays import UncertaintyBase
+from .sampling import get_random_number_generator, SAMPLING_METHODS
 from numpy import inf
+import numpy as np
 import copy
 
+IN_EXC_TYPES = ['techno_transfo_input', 'techno_treat_output', 'bio_ress']
+OUT_EXC_TYPES = ['techno_transfo_output', 'techno_treat_input', 'bio_emission']
+TREAT_EXC_TYPES = ['techno_treat_output', 'techno_treat_input']
+
 class ActivityWaterBalancer():
     """Balances water exchange samples at the activity level
 
@@ -13,6 +20,10 @@ class ActivityWaterBalancer():
     Use Method `generate_samples` to actually generate samples. This is usually
     invoked via a DatabaseWaterBalancer instance.
 
+    Instances can also be created from already loaded exchange data with
+    `from_exchange_data`, in which case nothing is read from or written to
+    the project database and samples are generated with numpy.
+
     Parameters:
     ------------
        act_key: tuple
@@ -22,39 +33,101 @@ class ActivityWaterBalancer():
     """
     def __init__(self, act_key, database_water_balancer):
         self.act = get_activity(act_key)
-        for keys in [
-            'techno_transfo_keys', 'techno_treat_keys',
-            'bio_ress_keys', 'bio_emission_keys',
-            'all_water_keys', 'group'
-        ]:
-            setattr(self, keys, getattr(database_water_balancer, keys))
+        self.act_key = self.act.key
+        self.group = database_water_balancer.group
+        self._set_water_key_index(database_water_balancer.water_key_index)
         water_exchanges = [
             exc for exc in self.act.exchanges()
-            if exc.input.key in self.all_water_keys
+            if exc['input'] in self.water_key_index
         ]
         if not water_exchanges:
-            self.strategy = "skip"
-            self.water_exchanges = water_exchanges
+            self._set_water_exchanges(water_exchanges)
         else:
             self._move_exchange_formulas_to_temp()
-            self.water_exchanges = [
+            self._set_water_exchanges([
                 exc for exc in self.act.exchanges()
-                if exc.input.key in self.all_water_keys
-            ]
-            self.water_exchange_input_keys = [exc.input.key for exc in self.water_exchanges]
-            self.water_exchange_types = [self._get_type(exc) for exc in self.water_exchanges]
-            namer = ParameterNameGenerator()
-            self.water_exchange_param_names = [namer['water_param'] for _ in range(len(self.water_exchanges))]
-            self.activity_params = []
+                if exc['input'] in self.water_key_index
+            ])
+
+    @classmethod
+    def from_exchange_data(cls, act_key, exchanges, water_key_index):
+        """Create instance from already loaded exchange data
 
-    def generate_samples(self, iterations=1000):
+        Used to balance activities without any database I/O, e.g. from the
+        exchanges of a single `Database.load()` or from data received by a
+        worker process. Water exchanges are copied, so `exchanges` are never
+        modified.
+
+        Parameters:
+        ------------
+           act_key: tuple
+               Key of the activity.
+           exchanges: list
+               Exchange data dictionaries of the activity, with `input`,
+               `amount`, `type` and `unit` and uncertainty fields.
+           water_key_index: WaterKeyIndex
+               Index of water keys, usually the `water_key_index` of a
+               DatabaseWaterBalancer instance
+        """
+        ab = cls.__new__(cls)
+        ab.act = None
+        ab.act_key = act_key
+        ab.group = None
+        ab._set_water_key_index(water_key_index)
+        ab._set_water_exchanges([
+            dict(exc) for exc in exchanges
+            if exc['input'] in water_key_index
+        ])
+        return ab
+
+    def _set_water_key_index(self, water_key_index):
+        """Set water key index and the water key lists it holds"""
+        self.water_key_index = water_key_index
+        for keys in [
+            'techno_transfo_keys', 'techno_treat_keys',
+            'bio_ress_keys', 'bio_emission_keys',
+            'all_water_keys'
+        ]:
+            setattr(self, keys, getattr(water_key_index, keys))
+
+    def _set_water_exchanges(self, water_exchanges):
+        """Set water exchanges, their types and generic parameter names"""
+        self.water_exchanges = water_exchanges
+        if not water_exchanges:
+            self.strategy = "skip"
+            return
+        self.water_exchange_input_keys = [exc['input'] for exc in self.water_exchanges]
+        self.water_exchange_types = [self._get_type(exc) for exc in self.water_exchanges]
+        namer = ParameterNameGenerator()
+        self.water_exchange_param_names = [namer['water_param'] for _ in range(len(self.water_exchanges))]
+        self.activity_params = []
+
+    def generate_samples(self, iterations=1000, chunk_size=None, sampling='random', seed=None):
         """Calls other methods in order and adds parameters to group
 
         Parameters:
         ------------
            iterations: int
                Number of iterations in sample.
+           chunk_size: int, optional
+               Maximum number of iterations calculated at once. If smaller
+               than `iterations`, samples are calculated in chunks that are
+               then concatenated, which bounds the memory used by the
+               parameterized model. Not used for instances created from
+               exchange data.
+           sampling: {'random', 'lhs', 'sobol', 'antithetic'}, default='random'
+               Method used to draw the uncertain water exchanges before
+               rebalancing: pseudo-random, Latin hypercube or Sobol sampling,
+               or pseudo-random antithetic pairs (see
+               `QuasiRandomNumberGenerator`)
+           seed: int, optional
+               Seed of the random number generator of uncertain water
+               exchanges, for reproducible samples
         """
+        if sampling not in SAMPLING_METHODS:
+            raise ValueError("Unknown sampling {}, use one of {}".format(sampling, SAMPLING_METHODS))
+        if self.act is None:
+            return self._generate_samples_from_exchanges(iterations, sampling, seed)
         if not self._processed():
             self.activity_params = []
             self._identify_strategy()
@@ -68,9 +141,7 @@ class ActivityWaterBalancer():
         parameters.recalculate()
         pbm = PBM(self.group)
         pbm.load_parameter_data()
-        pbm.calculate_stochastic(iterations, update_amounts=True)
-        pbm.calculate_matrix_presamples()
-        self.matrix_data = pbm.matrix_data
+        self.matrix_data = self._calculate_matrix_data(pbm, iterations, chunk_size, sampling, seed)
         parameters.remove_from_group(self.group, self.act)
         self.act['parameters'] = []
         self.act.save()
@@ -79,30 +150,168 @@ class ActivityWaterBalancer():
         self._restore_exchange_formulas()
         return self.matrix_data
 
+    def _calculate_matrix_data(self, pbm, iterations, chunk_size=None, sampling='random', seed=None):
+        """Return matrix data calculated in chunks of at most `chunk_size` iterations"""
+        rng = None
+        if sampling != 'random' or seed is not None:
+            rng = self._get_parameter_rng(pbm, sampling, seed)
+        if chunk_size is None or chunk_size >= iterations:
+            self._calculate_stochastic(pbm, iterations, rng)
+            pbm.calculate_matrix_presamples()
+            return pbm.matrix_data
+        # Amounts are overwritten with samples, restore them for every chunk
+        static_data = copy.deepcopy(pbm.data)
+        chunks = []
+        for start in range(0, iterations, chunk_size):
+            pbm.data = copy.deepcopy(static_data)
+            self._calculate_stochastic(pbm, min(chunk_size, iterations - start), rng)
+            pbm.calculate_matrix_presamples()
+            chunks.append(pbm.matrix_data)
+        return [
+            (np.concatenate([chunk[i][0] for chunk in chunks], axis=1), ) + tuple(chunks[0][i][1:])
+            for i in range(len(chunks[0]))
+        ]
+
+    @staticmethod
+    def _get_parameter_rng(pbm, sampling, seed=None):
+        """Return names and generator of samples of independent parameters of model"""
+        names = [name for name, param in pbm.data.items() if not param.get('formula')]
+        params = UncertaintyBase.from_dicts(*[
+            {
+                field: pbm.data[name][field] for field in [
+                    'amount', 'uncertainty type', 'loc', 'scale', 'shape',
+                    'minimum', 'maximum', 'negative'
+                ] if pbm.data[name].get(field) is not None
+            } for name in names
+        ])
+        return names, get_random_number_generator(params, sampling, seed)
+
+    @staticmethod
+    def _calculate_stochastic(pbm, iterations, rng=None):
+        """Calculate parameter samples, drawing independent parameters from `rng` if given"""
+        if rng is None:
+            pbm.calculate_stochastic(iterations, update_amounts=True)
+            return
+        names, generator = rng
+        # Samples of global parameters are used as is by the parameter set
+        pbm.global_params = dict(zip(names, generator.generate(iterations)))
+        try:
+            pbm.calculate_stochastic(iterations, update_amounts=True)
+        finally:
+            pbm.global_params = {}
+
+    def _generate_samples_from_exchanges(self, iterations, sampling='random', seed=None):
+        """Generate balanced samples with numpy, without database I/O"""
+        if getattr(self, 'strategy', None) is None:
+            self._identify_strategy()
+        if self.strategy == 'skip':
+            return []
+        samples, indices = self._balance_exchange_samples(iterations, sampling, seed)
+        self.matrix_data = split_inventory_presamples(samples, indices)
+        return self.matrix_data
+
+    def _balance_exchange_samples(self, iterations, sampling='random', seed=None):
+        """Return balanced samples and matrix indices of balanced exchanges
+
+        Same rebalancing as the formulas defined for the parameterized model,
+        applied to arrays of samples of all balanced exchanges.
+        """
+        exchanges, roles, coefficients = self._get_balancing_terms()
+        if self.strategy == 'set_static':
+            self.static_ratio = 'Not calculated'
+            self.static_balance = 'Not calculated'
+            return np.full((1, iterations), exchanges[0]['amount'], dtype=np.float64), [self._get_matrix_index(exchanges[0])]
+
+        in_total, out_total = self._get_static_totals()
+        if self.strategy == 'default':
+            self.static_ratio = in_total / out_total if out_total!=0 else inf
+            self.static_balance = in_total - out_total
+        else:
+            self.static_ratio = out_total / in_total
+            self.static_balance = out_total - in_total
+        samples = self._sample_exchanges(exchanges, iterations, sampling, seed)
+        variable, constant, reference = [roles == role for role in ['variable', 'constant', 'reference']]
+        scaling = (
+            self.static_ratio * (coefficients[reference] @ samples[reference])
+            - coefficients[constant] @ samples[constant]
+        ) / (coefficients[variable] @ samples[variable])
+        samples[variable] *= scaling
+        return samples, [self._get_matrix_index(exc) for exc in exchanges]
+
+    def _get_balancing_terms(self):
+        """Return balanced exchanges, with their role and signed coefficient in kg
+
+        For the default and inverse strategies, exchanges on the side of the
+        balance that is rescaled (inputs for default, outputs for inverse) are
+        'variable' if uncertain and 'constant' otherwise, and exchanges on
+        the other side are 'reference'. The static ratio is the ratio of
+        variable and constant terms to reference terms, and variable
+        exchanges are rescaled to maintain it.
+        For the set_static strategy, the only uncertain water exchange is
+        returned with a 'static' role.
+        """
+        if self.strategy == 'set_static':
+            excs = [exc for exc in self.water_exchanges if exc.get('uncertainty type', 0) != 0]
+            if len(excs) != 1:
+                raise ValueError("Should only have one variable water exchange for 'set_static' strategy")
+            return excs, np.array(['static']), self.water_key_index.get_conversion_factors_to_kg(excs)
+
+        types = np.array(self.water_exchange_types)
+        balanced = np.isin(types, IN_EXC_TYPES + OUT_EXC_TYPES)
+        exchanges = [exc for i, exc in enumerate(self.water_exchanges) if balanced[i]]
+        types = types[balanced]
+        rescaled = np.isin(types, IN_EXC_TYPES if self.strategy == 'default' else OUT_EXC_TYPES)
+        uncertain = np.array([exc.get('uncertainty type', 0) != 0 for exc in exchanges])
+        roles = np.where(rescaled, np.where(uncertain, 'variable', 'constant'), 'reference')
+        coefficients = self.water_key_index.get_conversion_factors_to_kg(exchanges) \
+            * np.where(np.isin(types, TREAT_EXC_TYPES), -1, 1)
+        return exchanges, roles, coefficients
+
+    def _sample_exchanges(self, exchanges, iterations, sampling='random', seed=None):
+        """Return array of independent samples of exchange amounts"""
+        params = UncertaintyBase.from_dicts(
+            *[self._convert_exchange_to_param(exc, None) for exc in exchanges]
+        )
+        rng = get_random_number_generator(params, sampling, seed)
+        return rng.generate(iterations).reshape(len(exchanges), iterations)
+
+    def _get_matrix_index(self, exc):
+        """Return (input key, output key, type) matrix index of exchange"""
+        return (exc['input'], self.act_key, exc['type'])
+
     def _identify_strategy(self):
         """Identify appropriate strategy to use for activity"""
 
         if not self.water_exchanges:
             return 'skip'
+        factors = self.water_key_index.get_conversion_factors_to_kg(self.water_exchanges)
         for i, exc in enumerate(self.water_exchanges):
             if self.water_exchange_types[i] == 'skip':
                 continue
-            exc['to_kg_conversion_factor'] = self._get_conversion_factor_to_kg(exc)
-            if exc['to_kg_conversion_factor'] is None:
+            if np.isnan(factors[i]):
                 self.water_exchange_types[i] = 'skip'
                 continue  # Can't deal with this exchange, unit not understood
+            exc['to_kg_conversion_factor'] = self._get_conversion_factor_to_kg(exc)
             exc['abnormal_sign'] = self._check_sign(exc, self.water_exchange_types[i])
-            exc.save()
-        out_exc_types = ['techno_transfo_output', 'techno_treat_input', 'bio_emission']
-        in_exc_types = ['techno_transfo_input', 'techno_treat_output', 'bio_ress']
+            if self.act is not None:
+                exc.save()
+        self.strategy = self._select_strategy(self.water_exchanges, self.water_exchange_types)
+
+    @staticmethod
+    def _select_strategy(water_exchanges, water_exchange_types):
+        """Return strategy given classified water exchanges
 
+        Exchanges can be exchange objects or exchange data dictionaries, such
+        as those returned by `Database.load()`, so that strategies can be
+        identified without touching the database.
+        """
         all_exc_out = [
-            exc for i, exc in enumerate(self.water_exchanges)
-            if self.water_exchange_types[i] in out_exc_types
+            exc for i, exc in enumerate(water_exchanges)
+            if water_exchange_types[i] in OUT_EXC_TYPES
         ]
         all_exc_in = [
-            exc for i, exc in enumerate(self.water_exchanges)
-            if self.water_exchange_types[i] in in_exc_types
+            exc for i, exc in enumerate(water_exchanges)
+            if water_exchange_types[i] in IN_EXC_TYPES
         ]
 
         # Identify non-zero exchanges
@@ -112,8 +321,7 @@ class ActivityWaterBalancer():
         # If there isn't at least one non-zero input water exchange and one non-zero
         # output water exchange, skip
         if any([not non_zero_in, not non_zero_out]):
-            self.strategy = "skip"
-            return
+            return "skip"
 
         # Identify water exchanges with uncertainty
         exc_with_uncertainty_inputs = [exc for exc in all_exc_in if exc.get('uncertainty type', 0) != 0]
@@ -121,16 +329,16 @@ class ActivityWaterBalancer():
 
         # If there aren't any uncertain water exchanges, skip
         if len(exc_with_uncertainty_inputs + exc_with_uncertainty_outputs) == 0:
-            self.strategy = "skip"
+            return "skip"
         # If there is only one uncertain water exchange, set_static
         elif len(exc_with_uncertainty_inputs + exc_with_uncertainty_outputs) == 1:
-            self.strategy = "set_static"
+            return "set_static"
         # If there are no uncertain inputs, inverse strategy (i.e. rescale outputs)
         elif len(exc_with_uncertainty_inputs) == 0:
-            self.strategy = "inverse"
+            return "inverse"
         # Apply default strategy otherwise (i.e. rescale inputs)
         else:
-            self.strategy = "default"
+            return "default"
 
     def _define_balancing_parameters(self):
         """Invoke strategy-specific method for generating parameters for rebalancing"""
@@ -155,20 +363,17 @@ class ActivityWaterBalancer():
         var_in_terms = []
         const_in_terms = []
         out_terms = []
-        in_total = 0
-        out_total = 0
+        in_total, out_total = self._get_static_totals()
 
         for i, exc in enumerate(self.water_exchanges):
             param_name = self.water_exchange_param_names[i]
             water_exchange_type = self.water_exchange_types[i]
-            exc_amount_value = exc.get('amount', 0) * exc.get('to_kg_conversion_factor')
+            if water_exchange_type not in IN_EXC_TYPES + OUT_EXC_TYPES:
+                continue
             exc_amount_string = "{} * {}".format(exc['to_kg_conversion_factor'], self.water_exchange_param_names[i])
             if water_exchange_type in ['techno_treat_output', 'techno_treat_input']:
-                exc_amount_value *= -1
                 exc_amount_string = "-" + exc_amount_string
-            if water_exchange_type in ['techno_transfo_input', 'techno_treat_output', 'bio_ress']:
-                # add amount to appropriate total for calculating ratio and balance
-                in_total += exc_amount_value
+            if water_exchange_type in IN_EXC_TYPES:
                 # generate term for ratio equation
                 term = exc_amount_string
                 # add exchange to activity parameters (exchange parameter will
@@ -186,8 +391,7 @@ class ActivityWaterBalancer():
                     # Add hook to exchange, without scaling (constant)
                     exc['water_formula'] = param_name
                     exc.save()
-            elif water_exchange_type in ['techno_transfo_output', 'techno_treat_input', 'bio_emission']:
-                out_total += exc_amount_value
+            elif water_exchange_type in OUT_EXC_TYPES:
                 # generate term for ratio equation
                 term = exc_amount_string
                 out_terms.append(term)
@@ -240,20 +444,17 @@ class ActivityWaterBalancer():
         var_out_terms = []
         const_out_terms = []
         in_terms = []
-        in_total = 0
-        out_total = 0
+        in_total, out_total = self._get_static_totals()
 
         for i, exc in enumerate(self.water_exchanges):
             param_name = self.water_exchange_param_names[i]
             water_exchange_type = self.water_exchange_types[i]
-            exc_amount_value = exc.get('amount', 0) * exc.get('to_kg_conversion_factor')
+            if water_exchange_type not in IN_EXC_TYPES + OUT_EXC_TYPES:
+                continue
             exc_amount_string = "{} * {}".format(exc['to_kg_conversion_factor'], self.water_exchange_param_names[i])
             if water_exchange_type in ['techno_treat_output', 'techno_treat_input']:
-                exc_amount_value *= -1
                 exc_amount_string = "-" + exc_amount_string
-            if water_exchange_type in ['techno_transfo_output', 'techno_treat_input', 'bio_emission']:
-                # add amount to appropriate total for calculating ratio and balance
-                out_total += exc_amount_value
+            if water_exchange_type in OUT_EXC_TYPES:
                 # generate term for ratio equation
                 term = exc_amount_string
                 # add exchange to activity parameters (exchange parameter will
@@ -271,8 +472,7 @@ class ActivityWaterBalancer():
                     # Add hook to exchange, without scaling (constant)
                     exc['water_formula'] = param_name
                     exc.save()
-            elif water_exchange_type in ['techno_transfo_input', 'techno_treat_output', 'bio_ress']:
-                in_total += exc_amount_value
+            elif water_exchange_type in IN_EXC_TYPES:
                 # generate term for ratio equation
                 term = exc_amount_string
                 in_terms.append(term)
@@ -316,6 +516,18 @@ class ActivityWaterBalancer():
             },
         )
 
+    def _get_static_totals(self):
+        """Return static water inputs and outputs, in kg"""
+        amounts = np.array([exc.get('amount', 0) for exc in self.water_exchanges], dtype=float)
+        factors = self.water_key_index.get_conversion_factors_to_kg(self.water_exchanges)
+        types = np.array(self.water_exchange_types)
+        # Treatment exchanges have negative amounts
+        signs = np.where(np.isin(types, TREAT_EXC_TYPES), -1, 1)
+        kg_amounts = amounts * factors * signs
+        in_total = kg_amounts[np.isin(types, IN_EXC_TYPES)].sum()
+        out_total = kg_amounts[np.isin(types, OUT_EXC_TYPES)].sum()
+        return float(in_total), float(out_total)
+
     def _get_static_data_set_static(self):
         """Define activity-level and exchange-level parameter to replace variable data with static data array
         """
@@ -344,9 +556,11 @@ class ActivityWaterBalancer():
             'loc': exc.get('loc', exc.get('amount', 0)),
             'scale': exc.get('scale'),
             'negative': exc.get('negative', False),
-            'database': self.act.get('database'),
-            'code': self.act.get('code'),
+            'database': self.act_key[0],
+            'code': self.act_key[1],
         }
+        if exc.get('shape') is not None:
+            param['shape'] = exc.get('shape')
         if exc.get('minimum') is not None:
             param['minimum'] = exc.get('minimum')
         if exc.get('maximum') is not None:
@@ -390,40 +604,11 @@ class ActivityWaterBalancer():
 
     def _get_type(self, exc):
         """Return type of water exchange"""
-        input_key = exc.input.key
-        if input_key in self.techno_transfo_keys:
-            if exc.get('type') == 'production':
-                return 'techno_transfo_output'
-            if exc.get('type') == 'technosphere':
-                return 'techno_transfo_input'
-        elif input_key in self.techno_treat_keys:
-            if exc.get('type') == 'production':
-                return 'techno_treat_output'
-            if exc.get('type') == 'technosphere':
-                return 'techno_treat_input'
-        elif input_key in self.bio_ress_keys:
-            return 'bio_ress'
-        elif input_key in self.bio_emission_keys:
-            return 'bio_emission'
-        # If not returned anything yet, it was impossible to classify
-        warnings.warn(
-            "Exchange type not understood for exchange "
-            "between {} and {} ({}), not considered in balance.".format(
-                exc.input.key, exc.output.key, exc.get('type')
-            ))
-        return 'skip'
+        return self.water_key_index.get_exchange_type(exc)
 
     def _get_conversion_factor_to_kg(self, exc):
         """Return a conversion factor to kg"""
-        if exc.get('unit') == 'kilogram':
-            return 1
-        elif exc.get('unit') == 'cubic meter':
-            return 1000
-        else:
-            warnings.warn("Unit for exchange between {} and {} "
-                          "not recognized, skipping".format(
-                exc.input.key, exc.output.key
-            ))
+        return self.water_key_index.get_conversion_factor_to_kg(exc)
 
     def _reset(self):
         """Reset attributes"""
@@ -1,12 +1,129 @@
 from brightway2 import *
 import numpy as np
+from bw2data.backends.peewee import sqlite3_lci_db
 from bw2data.backends.peewee.schema import ExchangeDataset
+from contextlib import contextmanager
+import copy
+import hashlib
 import json
+import multiprocessing
+from multiprocessing import sharedctypes
 import warnings
 from pathlib import Path
 import pyprind
-from .activity_water_balancer import ActivityWaterBalancer
-from presamples import create_presamples_package, split_inventory_presamples
+import queue
+from scipy import sparse
+import tempfile
+import threading
+import time
+import uuid
+from .activity_water_balancer import ActivityWaterBalancer, IN_EXC_TYPES, OUT_EXC_TYPES
+from .water_key_index import WaterKeyIndex
+from .water_incidence_matrix import WaterIncidenceMatrix
+from .water_sample_recipe import WaterSampleRecipe, RECIPE_BLOCK_SIZE
+from .in_memory_presamples import InMemoryPresamplesLoader
+from .output_backends import get_output_backend, _get_node_ids
+from .matrix_indices import MatrixIndices, MATRIX_TYPES
+from .sampling import SAMPLING_METHODS, get_stream_seed
+
+# Maximum number of activities held between two stages of the pipelined engine
+PIPELINE_QUEUE_SIZE = 16
+# Fixed cost of generating samples for an activity, in balanced exchanges
+ACT_COST_OVERHEAD = 2
+# Version of the format of files written by `DatabaseWaterBalancer.save_snapshot`
+SNAPSHOT_FORMAT_VERSION = 3
+
+# Water key index and shared samples array of worker processes of the parallel engine
+_worker_water_key_index = None
+_worker_samples = None
+
+def _init_worker(water_key_index, shared_block, shape, dtype, samples_filepath=None):
+    """Set the water key index and attach the shared samples array of a worker process
+
+    The shared samples array is either a block of shared memory or, if
+    `samples_filepath` is given, a memory-mapped .npy file.
+    """
+    global _worker_water_key_index, _worker_samples
+    _worker_water_key_index = water_key_index
+    if samples_filepath is not None:
+        _worker_samples = np.load(samples_filepath, mmap_mode='r+')
+        return
+    _worker_samples = np.frombuffer(shared_block, dtype=dtype).reshape(shape)
+
+def _generate_samples_in_worker(task):
+    """Balance an activity in a worker process
+
+    Samples are written in place in the rows of the shared samples array
+    planned for the activity. Returns the activity key, the first planned
+    row, the matrix indices of written rows and an error message, if any.
+    """
+    act_key, exchanges, iterations, sampling, seed, row_start, n_rows = task
+    try:
+        ab = ActivityWaterBalancer.from_exchange_data(act_key, exchanges, _worker_water_key_index)
+        indices = []
+        for samples, data_indices, label in ab.generate_samples(iterations, sampling=sampling, seed=seed):
+            if label == 'biosphere':
+                data_indices = [(row[0], row[1], 'biosphere') for row in data_indices]
+            indices.extend(data_indices)
+        if len(indices) != n_rows:
+            raise ValueError("{} rows of samples generated, {} planned".format(len(indices), n_rows))
+        row = row_start
+        for samples, _, _ in ab.matrix_data:
+            _worker_samples[row:row + samples.shape[0]] = samples
+            row += samples.shape[0]
+        return act_key, row_start, indices, None
+    except Exception as err:
+        return act_key, row_start, [], str(err)
+
+def identify_bio_water_keys(biosphere, database_names):
+    """Identify keys of water elementary flows used by each database
+
+    Water elementary flows are classified once, and their use by all
+    databases is found with a single grouped query.
+
+    Parameters:
+    -----------
+       biosphere: str
+           Name of the biosphere database
+       database_names: list
+           Names of LCI databases using the biosphere database
+
+    Returns:
+    --------
+       dict with, for each database name, the lists of keys of water
+       elementary flows from nature and to nature used by the database
+    """
+    bio_loaded = Database(biosphere).load()
+    water_flows = [
+        (ef_key, ef) for ef_key, ef in pyprind.prog_bar(bio_loaded.items())
+        if "Water" in ef['name']
+    ]
+    used = {database_name: set() for database_name in database_names}
+    query = ExchangeDataset.select(
+        ExchangeDataset.input_code, ExchangeDataset.output_database
+    ).where(
+        (ExchangeDataset.input_database == biosphere)
+        & (ExchangeDataset.output_database.in_(list(database_names)))
+    ).distinct().tuples()
+    for input_code, output_database in query:
+        used[output_database].add(input_code)
+
+    bio_keys = {database_name: ([], []) for database_name in database_names}
+    for ef_key, ef in water_flows:
+        users = [database_name for database_name in database_names if ef_key[1] in used[database_name]]
+        if not users:
+            continue
+        if ef.get('type') == 'natural resource':
+            position = 0
+        elif ef.get('type') == 'emission':
+            position = 1
+        else:
+            warnings.warn("Elementary flow type not understood for {}".format(ef))
+            continue
+        for database_name in users:
+            bio_keys[database_name][position].append(ef_key)
+    return bio_keys
+
 
 class DatabaseWaterBalancer():
     """Generate database-level balanced water samples to override unbalanced samples
@@ -40,6 +157,18 @@ class DatabaseWaterBalancer():
         Name of the biosphere database in the brighway2 database
     group: string, default='water'
         Name of the parameter group name. Used in the generation of samples.
+    dtype: numpy floating dtype, default=np.float64
+        Data type used to store and write samples. Balancing is always done
+        in float64, and samples are only downcast once balanced. Use
+        np.float32 to halve memory use and package size.
+    unit_conversions: dict, optional
+        Factors converting water exchange amounts to kg, by unit name. Added
+        to, and take precedence over, `DEFAULT_UNIT_CONVERSIONS` (see
+        `WaterKeyIndex`). Units can also be added later with `register_unit`.
+    bio_keys: tuple, optional
+        Keys of water elementary flows from and to nature used by activities
+        in database, if already identified (e.g. by a
+        `MultiDatabaseWaterBalancer`)
 
     Attributes:
     -----------
@@ -64,25 +193,31 @@ class DatabaseWaterBalancer():
         Name of the biosphere database in the brighway2 database
     group: string, default='water'
         Name of the parameter group name. Used in the generation of samples.
-    matrix_indices: list
-        List of numpy structured arrays containing the matrix indices associated
-        with samples
+    matrix_indices: MatrixIndices
+        Matrix indices associated with samples, stored in a numpy structured
+        array
     matrix_samples: list
         List of numpy arrays with samples
+    dtype: numpy.dtype
+        Data type of stored samples
+    water_key_index: WaterKeyIndex
+        Index of all water keys, used to classify water exchanges and convert
+        their amounts to kg
+    incidence_matrix: WaterIncidenceMatrix or None
+        Sparse water balances of all activities, see `build_incidence_matrix`
+    activity_plans: dict or None
+        Strategy, number of balanced exchanges and cost of each activity, as
+        returned in the `activities` of `plan`. Only set for instances loaded
+        with `load_snapshot`, in which case it is used to size samples.
+    samples_filepath: Path or None
+        Path of the file samples are streamed to when `add_samples_for_all_acts`
+        is run with a `memory_limit` that the samples do not fit in
     """
-    def __init__(self, ecoinvent_version, database_name, biosphere='biosphere3', group="water"):
+    def __init__(self, ecoinvent_version, database_name, biosphere='biosphere3', group="water",
+                 dtype=np.float64, unit_conversions=None, bio_keys=None):
 
-        # Check that the database exists in the current project
         print("Validating data")
-        if database_name not in databases:
-            raise ValueError("Database {} not imported".format(database_name))
-        self.database_name = database_name
-        if biosphere not in databases:
-            raise ValueError("Database {} not imported".format(biosphere))
-        self.biosphere = biosphere
-        self.group = group
-        self.matrix_indices = []
-        self.matrix_samples = None
+        self._set_configuration(database_name, biosphere, group, dtype)
 
         # Check that data is available for current version
         available_versions = ['test_db', '3.4', '3.6'] # todo possibly use migrations for this
@@ -97,16 +232,182 @@ class DatabaseWaterBalancer():
 
         # Identify water exchanges
         print("Getting information on technosphere water exchanges")
-        self.techno_transfo_keys, self.techno_treat_keys = self._identify_techno_keys()
+        techno_transfo_keys, techno_treat_keys = self._identify_techno_keys()
+
+        if bio_keys is None:
+            print("Getting information on biosphere water exchanges")
+            bio_ress_keys, bio_emission_keys = self._identify_bio_keys()
+        else:
+            bio_ress_keys, bio_emission_keys = [list(keys) for keys in bio_keys]
+
+        self._set_water_keys(
+            techno_transfo_keys, techno_treat_keys,
+            bio_ress_keys, bio_emission_keys,
+            unit_conversions
+        )
 
-        print("Getting information on biosphere water exchanges")
-        self.bio_ress_keys, self.bio_emission_keys = self._identify_bio_keys()
+    def _set_configuration(self, database_name, biosphere, group, dtype):
+        """Validate and set databases, parameter group and dtype, with no samples"""
+        # Check that the database exists in the current project
+        if database_name not in databases:
+            raise ValueError("Database {} not imported".format(database_name))
+        self.database_name = database_name
+        if biosphere not in databases:
+            raise ValueError("Database {} not imported".format(biosphere))
+        self.biosphere = biosphere
+        self.group = group
+        self.dtype = np.dtype(dtype)
+        if not np.issubdtype(self.dtype, np.floating):
+            raise ValueError("dtype must be a floating point type, got {}".format(self.dtype))
+        self.matrix_indices = MatrixIndices()
+        self.matrix_samples = None
+        self.samples_filepath = None
+        self.incidence_matrix = None
+        self.activity_plans = None
+        self._sample_buffer = None
 
+    def _set_water_keys(self, techno_transfo_keys, techno_treat_keys, bio_ress_keys,
+                        bio_emission_keys, unit_conversions=None):
+        """Set lists of water keys and the water key index built from them"""
+        self.techno_transfo_keys = techno_transfo_keys
+        self.techno_treat_keys = techno_treat_keys
+        self.bio_ress_keys = bio_ress_keys
+        self.bio_emission_keys = bio_emission_keys
         self.all_water_keys = \
             self.techno_transfo_keys + self.techno_treat_keys + \
             self.bio_ress_keys + self.bio_emission_keys
+        self.water_key_index = WaterKeyIndex(
+            self.techno_transfo_keys, self.techno_treat_keys,
+            self.bio_ress_keys, self.bio_emission_keys,
+            unit_conversions=unit_conversions
+        )
+
+    def save_snapshot(self, filepath):
+        """Save classified water keys, activity plans and configuration
+
+        The snapshot is a JSON file from which `load_snapshot` creates an
+        initialized instance without identifying water keys again. Samples
+        are not saved.
+
+        Parameters:
+        -----------
+           filepath: str or Path
+               Path of the snapshot file
+        """
+        activity_plans = self.plan(0, calibration_size=0)['activities']
+        snapshot = {
+            'format_version': SNAPSHOT_FORMAT_VERSION,
+            'ecoinvent_version': self.ecoinvent_version,
+            'database_name': self.database_name,
+            'biosphere': self.biosphere,
+            'group': self.group,
+            'dtype': self.dtype.str,
+            'modified': [databases[self.database_name].get('modified'), databases[self.biosphere].get('modified')],
+            'fingerprint': self._get_snapshot_fingerprint(),
+            'unit_conversions': self.water_key_index.unit_conversions,
+            'activity_plans': [
+                list(act_key) + [act_plan['strategy'], act_plan['exchanges'], act_plan['cost']]
+                for act_key, act_plan in activity_plans.items()
+            ],
+        }
+        for keys in ['techno_transfo_keys', 'techno_treat_keys', 'bio_ress_keys', 'bio_emission_keys']:
+            snapshot[keys] = [list(key) for key in getattr(self, keys)]
+        with open(filepath, "w") as f:
+            json.dump(snapshot, f)
+
+    @classmethod
+    def load_snapshot(cls, filepath, check='modified'):
+        """Create an initialized instance from a snapshot saved with `save_snapshot`
+
+        Warns if data the snapshot depends on were modified after it was
+        saved. By default, only the modification times of databases are
+        compared, without loading them. Any change to a database, including
+        formulas written by the parameters engine, is then reported.
+
+        Parameters:
+        -----------
+           filepath: str or Path
+               Path of the snapshot file
+           check: {'modified', 'fingerprint', None}, default='modified'
+               'modified' compares modification times of databases,
+               'fingerprint' loads databases and compares the data water keys
+               and activity plans depend on (see `_get_snapshot_fingerprint`),
+               None does not check, e.g. in workers
+        """
+        if check not in ('modified', 'fingerprint', None):
+            raise ValueError("Unknown check {}, use 'modified', 'fingerprint' or None".format(check))
+        with open(filepath, "r") as f:
+            snapshot = json.load(f)
+        if snapshot.get('format_version') != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError("Snapshot format version {} not supported".format(snapshot.get('format_version')))
+        dwb = cls.__new__(cls)
+        dwb._set_configuration(snapshot['database_name'], snapshot['biosphere'],
+                               snapshot['group'], snapshot['dtype'])
+        dwb.ecoinvent_version = snapshot['ecoinvent_version']
+        dwb._set_water_keys(
+            *[[tuple(key) for key in snapshot[keys]] for keys in [
+                'techno_transfo_keys', 'techno_treat_keys', 'bio_ress_keys', 'bio_emission_keys'
+            ]],
+            unit_conversions=snapshot['unit_conversions']
+        )
+        if check == 'modified' and snapshot['modified'] != [
+                databases[dwb.database_name].get('modified'), databases[dwb.biosphere].get('modified')]:
+            warnings.warn("Databases {} or {} were modified after the snapshot was saved, "
+                          "water keys and activity plans may be outdated, use check='fingerprint' "
+                          "to compare their water data".format(dwb.database_name, dwb.biosphere))
+        elif check == 'fingerprint' and dwb._get_snapshot_fingerprint() != snapshot['fingerprint']:
+            warnings.warn("Databases {} and {} were modified after the snapshot was saved, "
+                          "water keys and activity plans may be outdated".format(
+                dwb.database_name, dwb.biosphere
+            ))
+        dwb.activity_plans = {
+            (database, code): {'strategy': strategy, 'exchanges': exchanges, 'cost': cost}
+            for database, code, strategy, exchanges, cost in snapshot['activity_plans']
+        }
+        return dwb
 
-    def add_samples_for_act(self, act_key, iterations):
+    def _get_snapshot_fingerprint(self):
+        """Return hash of the database data water keys and activity plans are identified from
+
+        The hash covers the key, reference product and production amount of
+        each activity, the data of its exchanges with water keys or water
+        elementary flows (input, type, amount, unit and uncertainty) and the
+        name, categories and unit of water elementary flows. Fields written
+        by balancers, such as formulas, are not covered, so that generating
+        samples does not make a snapshot outdated.
+        """
+        water_flows = {
+            ef_key: [ef.get('name'), list(ef.get('categories', [])), ef.get('unit')]
+            for ef_key, ef in Database(self.biosphere).load().items()
+            if "Water" in ef['name']
+        }
+        water_keys = set(water_flows).union(self.all_water_keys)
+        fields = ['type', 'amount', 'unit', 'uncertainty type', 'loc', 'scale', 'shape',
+                  'minimum', 'maximum', 'negative']
+        activities = []
+        for act_key, act in sorted(Database(self.database_name).load().items()):
+            exchanges = sorted(
+                [list(exc['input']) + [exc.get(field) for field in fields]
+                 for exc in act.get('exchanges', []) if exc['input'] in water_keys],
+                key=repr
+            )
+            activities.append([list(act_key), act.get('reference product'), act.get('production amount'), exchanges])
+        data = json.dumps([sorted([list(key), flow] for key, flow in water_flows.items()), activities], default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def register_unit(self, unit, factor):
+        """Register factor converting amounts in `unit` to kg
+
+        Parameters:
+        -----------
+           unit: str
+               Unit name, as found in exchange data. Not case sensitive.
+           factor: float
+               Mass of water, in kg, of one `unit`
+        """
+        self.water_key_index.register_unit(unit, factor)
+
+    def add_samples_for_act(self, act_key, iterations, chunk_size=None, sampling='random'):
         """Add samples and indices for given activity
 
         Actual samples generated by a ActivityWaterBalancer instance.
@@ -120,43 +421,828 @@ class DatabaseWaterBalancer():
                Key of target activity in database
            iterations: int
                Number of iterations in generated samples
+           chunk_size: int, optional
+               Maximum number of iterations calculated at once
+           sampling: {'random', 'lhs', 'sobol', 'antithetic'}, default='random'
+               Method used to draw uncertain water exchanges, see
+               `ActivityWaterBalancer.generate_samples`
         """
         ab = ActivityWaterBalancer(act_key, self)
-        for data in ab.generate_samples(iterations):
+        self._store_matrix_data(ab.generate_samples(iterations, chunk_size=chunk_size, sampling=sampling))
+
+    def _store_matrix_data(self, matrix_data):
+        """Store samples and indices of matrix data generated for an activity"""
+        for data in matrix_data:
             if len(data[1][0])==2:
-                for row in data[1]:
-                    self.matrix_indices.append((row[0], row[1], 'biosphere'))
+                self.matrix_indices.extend(data[1], matrix_type='biosphere')
             else:
                 self.matrix_indices.extend(data[1])
+            self._store_samples(data[0])
+
+    def add_samples_for_all_acts(self, iterations, memory_limit=None, spill_dirpath=None,
+                                 engine='parameters', seed=None, processes=None, sampling='random',
+                                 start=0):
+        """Add samples and indices for all activities in database
+
+        With the default 'parameters' engine, iterates through all activities
+        in database and calls activity-level method add_samples_for_act.
+        With the 'vectorized' engine, all activities are instead balanced at
+        once with the sparse water incidence matrix of the database (see
+        `build_incidence_matrix`), without any per-activity database I/O.
+        With the 'pipelined' engine, exchanges of the next activities are
+        read in a prefetch thread while a compute thread balances activities
+        with numpy and the calling thread stores their samples, so that
+        database reads, balancing and writes overlap.
+        With the 'parallel' engine, activities are balanced in `processes`
+        worker processes, largest estimated cost first, each idle worker
+        taking the next activity (see `schedule_acts`).
+
+        If a `memory_limit` is given, the number of water exchanges of each
+        activity is first planned and used to size the storage of samples and
+        the iteration chunks:
+            * a quarter of the budget bounds the memory used to calculate
+              samples, which sets the chunk size (not used by the pipelined
+              engine);
+            * samples are stored in a preallocated array if they fit in half
+              the budget, and are otherwise streamed to a file on disk
+              (`samples_filepath`), flushed every quarter of the budget.
+
+        Parameters:
+        -----------
+           iterations: int
+               Number of iterations in generated samples
+           memory_limit: int, optional
+               Approximate memory budget, in bytes
+           spill_dirpath: str, optional
+               Directory in which samples are streamed if they do not fit in
+               memory. A temporary directory is used if not set.
+           engine: {'parameters', 'vectorized', 'pipelined', 'parallel'}, default='parameters'
+               Engine used to generate samples
+           seed: int, optional
+               Seed of the random streams, for reproducible samples. Each
+               activity has its own stream (see `get_stream_seed`), except
+               with the vectorized engine, which draws all activities from
+               a single stream.
+           processes: int, optional
+               Number of worker processes of the parallel engine. Defaults to
+               the number of CPUs.
+           sampling: {'random', 'lhs', 'sobol', 'antithetic'}, default='random'
+               Method used to draw uncertain water exchanges, see
+               `ActivityWaterBalancer.generate_samples`
+           start: int, default=0
+               Index of the first generated iteration in the random streams.
+               Blocks of iterations with different `start` are drawn from
+               independent parts of the streams, see
+               `append_samples_for_all_acts`.
+        """
+        if sampling not in SAMPLING_METHODS:
+            raise ValueError("Unknown sampling {}, use one of {}".format(sampling, SAMPLING_METHODS))
+        if engine == 'vectorized':
+            self._add_vectorized_samples_for_all_acts(
+                iterations, memory_limit, spill_dirpath, get_stream_seed(seed, start), sampling
+            )
+            return
+        elif engine not in ['parameters', 'pipelined', 'parallel']:
+            raise ValueError(
+                "Unknown engine {}, use 'parameters', 'vectorized', 'pipelined' "
+                "or 'parallel'".format(engine)
+            )
+        if engine == 'parallel':
+            self._add_parallel_samples_for_all_acts(
+                iterations, processes, sampling, seed, start, memory_limit, spill_dirpath
+            )
+            return
+        act_keys = [act.key for act in Database(self.database_name)]
+        chunk_size = None
+        if memory_limit is not None:
+            activity_plans = self.activity_plans or self.plan(iterations, calibration_size=0)['activities']
+            n_exchanges = sum(act['exchanges'] for act in activity_plans.values())
+            max_exchanges = max([act['exchanges'] for act in activity_plans.values()] + [1])
+            # The parameterized model holds, in float64, parameter samples,
+            # exchange samples and two copies of the matrix data
+            bytes_per_iteration = (4 * max_exchanges + 3) * np.dtype(np.float64).itemsize
+            chunk_size = int(max(1, min(iterations, memory_limit // 4 // bytes_per_iteration)))
+            self._allocate_sample_buffer(n_exchanges, iterations, memory_limit, spill_dirpath)
+        try:
+            if engine == 'pipelined':
+                self._add_pipelined_samples_for_acts(act_keys, iterations, sampling=sampling, seed=seed, start=start)
+                return
+            for _, _, samples, indices in self.iter_samples(iterations, chunk_size, sampling, seed, start):
+                if indices:
+                    self.matrix_indices.extend(indices)
+                    self._store_samples(samples)
+        finally:
+            self._release_sample_buffer()
+
+    def append_samples_for_all_acts(self, iterations, seed=None, dirpath=None, **kwargs):
+        """Generate additional iterations and append them to existing samples
+
+        Existing samples are `matrix_samples` or, if `dirpath` is given, the
+        samples of a written presamples package, which then replace
+        `matrix_samples` and `matrix_indices`. Only the additional iterations
+        are generated, from the block of the random streams that starts after
+        the existing iterations (see the `start` argument of
+        `add_samples_for_all_acts`). Given the same `seed`, samples are thus
+        reproducible and independent of existing samples. Samples are
+        appended column-wise, in the rows of existing samples with the same
+        index; production and technosphere samples of the same exchange are
+        collapsed as in presamples packages.
+
+        Appended samples are written, a chunk of iterations at a time, in a
+        preallocated array of all iterations which, with a `memory_limit`,
+        is streamed to a file in `spill_dirpath` if it does not fit in half
+        the budget (see `add_samples_for_all_acts`).
+
+        Parameters:
+        -----------
+           iterations: int
+               Number of additional iterations
+           seed: int, optional
+               Seed of the random streams, as used for existing samples
+           dirpath: str or Path, optional
+               Directory of a presamples package of the database
+           kwargs:
+               Passed to `add_samples_for_all_acts` (engine, memory_limit,
+               processes, sampling...)
+        """
+        if dirpath is None:
+            if self.matrix_samples is None:
+                raise ValueError("No samples to append to, run `add_samples_for_all_acts` first")
+            samples, indices = self.matrix_samples, list(self.matrix_indices)
+        else:
+            keys = [act.key for act in Database(self.database_name)] + self.bio_ress_keys + self.bio_emission_keys
+            samples, indices = self._load_presamples_matrix_data(dirpath, keys)
+        samples_filepath = self.samples_filepath
+        self.matrix_indices = MatrixIndices()
+        self.matrix_samples = None
+        self.samples_filepath = None
+        memory_limit = kwargs.get('memory_limit')
+        try:
+            self.add_samples_for_all_acts(iterations, seed=seed, start=samples.shape[1], **kwargs)
             if self.matrix_samples is None:
-                self.matrix_samples = data[0]
+                raise ValueError("No samples generated")
+            to_existing_rows = self._map_sample_rows(list(self.matrix_indices), indices)
+            new_samples, new_filepath = self.matrix_samples, self.samples_filepath
+            n_existing = samples.shape[1]
+            self.matrix_samples = None
+            self._allocate_sample_buffer(
+                len(indices), n_existing + iterations, memory_limit, kwargs.get('spill_dirpath')
+            )
+            # Iterations of existing and new samples, in float64, held at once
+            bytes_per_iteration = (len(indices) + new_samples.shape[0]) * np.dtype(np.float64).itemsize
+            chunk_size = n_existing + iterations if memory_limit is None \
+                else int(max(1, memory_limit // 4 // bytes_per_iteration))
+            for start in range(0, n_existing, chunk_size):
+                stop = min(start + chunk_size, n_existing)
+                self._sample_buffer[:, start:stop] = samples[:, start:stop]
+                self._flush_sample_buffer((stop - start) * len(indices) * self.dtype.itemsize)
+            for start in range(0, iterations, chunk_size):
+                stop = min(start + chunk_size, iterations)
+                self._sample_buffer[:, n_existing + start:n_existing + stop] = \
+                    to_existing_rows @ np.asarray(new_samples[:, start:stop], dtype=np.float64)
+                self._flush_sample_buffer((stop - start) * len(indices) * self.dtype.itemsize)
+            self._buffer_cursor = len(indices)
+            self._release_sample_buffer()
+        except Exception:
+            self._sample_buffer = None
+            self.matrix_indices = MatrixIndices(indices)
+            self.matrix_samples = samples
+            self.samples_filepath = samples_filepath
+            raise
+        self.matrix_indices = MatrixIndices(indices)
+        del new_samples
+        if new_filepath is not None:
+            # New samples were streamed to a file of their own
+            new_filepath.unlink()
+
+    @staticmethod
+    def _map_sample_rows(indices, target_indices):
+        """Return sparse matrix adding rows of samples to rows with the same index in target
+
+        Rows with the same index are matched in order, and rows in excess are
+        added to the last target row with their index. Technosphere rows
+        whose only target is a production row of the same (input, output)
+        pair are subtracted from it, as when presamples collapses indices.
+        """
+        target_rows, pair_rows = {}, {}
+        for row, index in enumerate(target_indices):
+            target_rows.setdefault(tuple(index), []).append(row)
+            pair_rows.setdefault(tuple(index[:2]), row)
+        next_match = {index: 0 for index in target_rows}
+        rows, columns, signs = [], [], []
+        matched = np.zeros(len(target_indices), dtype=bool)
+        for column, index in enumerate(indices):
+            index = tuple(index)
+            pair_row = pair_rows.get(index[:2])
+            sign = 1
+            if index in target_rows:
+                position = min(next_match[index], len(target_rows[index]) - 1)
+                row = target_rows[index][position]
+                next_match[index] += 1
+            elif index[2] == 'technosphere' and pair_row is not None \
+                    and target_indices[pair_row][2] == 'production':
+                row, sign = pair_row, -1
             else:
-                self.matrix_samples = np.concatenate(
-                    [self.matrix_samples, data[0]], axis=0
-                )
+                raise ValueError("No existing samples with index {}".format(index))
+            rows.append(row)
+            columns.append(column)
+            signs.append(sign)
+            matched[row] = True
+        if not matched.all():
+            raise ValueError("No samples generated for index {}".format(
+                target_indices[int(np.flatnonzero(~matched)[0])]
+            ))
+        return sparse.csr_matrix((signs, (rows, columns)), shape=(len(target_indices), len(indices)))
 
-    def add_samples_for_all_acts(self, iterations):
-        """Add samples and indices for all activities in database
+    def iter_samples(self, iterations, chunk_size=None, sampling='random', seed=None, start=0):
+        """Yield balanced samples of each activity in database, without storing them
 
-        Iterates through all activities in database and calls activity-
-        level method add_samples_for_act
+        Samples are generated as in `add_samples_for_act`, but are neither
+        added to `matrix_samples` nor to `matrix_indices`.
 
         Parameters:
         -----------
            iterations: int
                Number of iterations in generated samples
+           chunk_size: int, optional
+               Maximum number of iterations calculated at once
+           sampling: {'random', 'lhs', 'sobol', 'antithetic'}, default='random'
+               Method used to draw uncertain water exchanges, see
+               `ActivityWaterBalancer.generate_samples`
+           seed: int, optional
+               Seed of the random streams of activities
+           start: int, default=0
+               Index of the first generated iteration in the random streams
+
+        Yields:
+        -------
+           (act_key, strategy, samples, indices) tuples, with `samples` an
+           array (exchanges x iterations) and `indices` the (input key,
+           output key, matrix type) index of each of its rows. Skipped
+           activities have no rows. Activities for which samples could not
+           be generated are reported and not yielded.
         """
         act_keys = [act.key for act in Database(self.database_name)]
         for act_key in pyprind.prog_bar(act_keys):
             try:
-                self.add_samples_for_act(get_activity(act_key), iterations)
+                ab = ActivityWaterBalancer(act_key, self)
+                matrix_data = ab.generate_samples(iterations, chunk_size=chunk_size, sampling=sampling,
+                                                  seed=get_stream_seed(seed, act_key, start))
             except Exception as err:
                 print(act_key, str(err))
+                continue
+            samples, indices = self._combine_matrix_data(matrix_data, iterations)
+            yield act_key, ab.strategy, samples, indices
+
+    @staticmethod
+    def _combine_matrix_data(matrix_data, iterations):
+        """Return samples and (input key, output key, matrix type) indices of all matrix data"""
+        if not matrix_data:
+            return np.empty((0, iterations), dtype=np.float64), []
+        indices = []
+        for data in matrix_data:
+            if len(data[1][0])==2:
+                indices.extend([(row[0], row[1], 'biosphere') for row in data[1]])
+            else:
+                indices.extend(data[1])
+        return np.concatenate([data[0] for data in matrix_data], axis=0), indices
+
+    def _add_pipelined_samples_for_acts(self, act_keys, iterations, queue_size=PIPELINE_QUEUE_SIZE,
+                                        sampling='random', seed=None, start=0):
+        """Add samples and indices for activities with overlapping stages
+
+        A prefetch thread reads the exchanges of activities, a compute thread
+        balances them without database I/O (see
+        `ActivityWaterBalancer.from_exchange_data`) and the calling thread
+        stores their samples. Stages are connected by queues holding at most
+        `queue_size` activities.
+        """
+        read_queue = queue.Queue(maxsize=queue_size)
+        write_queue = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        errors = []
+
+        def put(stage_queue, item):
+            # Give up if the downstream stage stopped consuming
+            while not stop.is_set():
+                try:
+                    stage_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def get(stage_queue):
+            # Return the sentinel if the downstream stage stopped consuming
+            while not stop.is_set():
+                try:
+                    return stage_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return None
+
+        def prefetch():
+            try:
+                for act_key in act_keys:
+                    if stop.is_set():
+                        return
+                    put(read_queue, (act_key, [exc.as_dict() for exc in get_activity(act_key).exchanges()]))
+            except Exception as err:
+                errors.append(err)
+            finally:
+                put(read_queue, None)
+
+        def compute():
+            try:
+                for act_key, exchanges in iter(lambda: get(read_queue), None):
+                    try:
+                        ab = ActivityWaterBalancer.from_exchange_data(act_key, exchanges, self.water_key_index)
+                        put(write_queue, ab.generate_samples(
+                            iterations, sampling=sampling, seed=get_stream_seed(seed, act_key, start)
+                        ))
+                    except Exception as err:
+                        print(act_key, str(err))
+                        put(write_queue, [])
+            finally:
+                put(write_queue, None)
+
+        threads = [threading.Thread(target=stage, daemon=True) for stage in [prefetch, compute]]
+        for thread in threads:
+            thread.start()
+        bar = pyprind.ProgBar(len(act_keys))
+        try:
+            for matrix_data in iter(write_queue.get, None):
+                self._store_matrix_data(matrix_data)
+                bar.update()
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+
+    def _add_vectorized_samples_for_all_acts(self, iterations, memory_limit=None, spill_dirpath=None,
+                                             seed=None, sampling='random'):
+        """Add samples and indices for all activities using the incidence matrix"""
+        incidence_matrix = self.build_incidence_matrix()
+        n_rows = len(incidence_matrix)
+        if not n_rows:
+            return
+        if memory_limit is None:
+            for samples in incidence_matrix.generate_samples(iterations, seed=seed, sampling=sampling):
+                self._store_samples(samples)
+            self.matrix_indices.extend(incidence_matrix.indices)
+            return
+        # Samples and their products with the three role matrices, in float64
+        bytes_per_iteration = (n_rows + 4 * len(incidence_matrix.act_keys)) * np.dtype(np.float64).itemsize
+        chunk_size = int(max(1, min(iterations, memory_limit // 4 // bytes_per_iteration)))
+        self._allocate_sample_buffer(n_rows, iterations, memory_limit, spill_dirpath)
+        try:
+            rows = slice(self._buffer_cursor, self._buffer_cursor + n_rows)
+            column = 0
+            for samples in incidence_matrix.generate_samples(iterations, seed=seed, chunk_size=chunk_size,
+                                                             sampling=sampling):
+                self._sample_buffer[rows, column:column + samples.shape[1]] = samples
+                column += samples.shape[1]
+                self._flush_sample_buffer(samples.size * self.dtype.itemsize)
+            self._buffer_cursor = rows.stop
+            self.matrix_indices.extend(incidence_matrix.indices)
+        finally:
+            self._release_sample_buffer()
+
+    def _add_parallel_samples_for_all_acts(self, iterations, processes=None, sampling='random',
+                                           seed=None, start=0, memory_limit=None, spill_dirpath=None):
+        """Add samples and indices for all activities using worker processes
+
+        Activities are sent to workers one at a time, in the order given by
+        `schedule_acts`, so that workers that are done with small activities
+        take the remaining ones while heavy activities are being balanced.
+        Rows of a shared samples array are planned for each activity:
+        workers write samples in place and only send back matrix indices.
+        Rows of activities that failed are dropped.
+
+        The shared samples array, which includes existing samples, is held
+        in shared memory, unless it does not fit in half the `memory_limit`,
+        in which case it is a file in `spill_dirpath` mapped by all
+        processes. It then becomes `matrix_samples`, without being copied:
+        a shared block is freed once no array uses it.
+        """
+        balancers = self.schedule_acts()
+        row_counts = [self._count_balanced_exchanges(ab) for ab in balancers]
+        row_starts = np.concatenate([[0], np.cumsum(row_counts, dtype=np.int64)])
+        if not row_starts[-1]:
+            return
+        n_existing = 0
+        if self.matrix_samples is not None:
+            if self.matrix_samples.shape[1] != iterations:
+                raise ValueError("Existing samples have {} iterations, not {}".format(
+                    self.matrix_samples.shape[1], iterations
+                ))
+            n_existing = self.matrix_samples.shape[0]
+        row_starts += n_existing
+        shape = (int(row_starts[-1]), iterations)
+        tasks = [
+            (ab.act_key, ab.water_exchanges, iterations, sampling,
+             get_stream_seed(seed, ab.act_key, start), int(row_start), n_rows)
+            for ab, row_start, n_rows in zip(balancers, row_starts, row_counts)
+        ]
+        nbytes = shape[0] * shape[1] * self.dtype.itemsize
+        shared_block, samples_filepath = None, None
+        if memory_limit is not None and nbytes > memory_limit // 2:
+            samples_filepath = Path(spill_dirpath or tempfile.mkdtemp()) / "{}.samples.npy".format(uuid.uuid4().hex)
+            samples = np.lib.format.open_memmap(samples_filepath, mode='w+', dtype=self.dtype, shape=shape)
+        else:
+            shared_block = sharedctypes.RawArray('b', nbytes)
+            samples = np.frombuffer(shared_block, dtype=self.dtype).reshape(shape)
+        try:
+            if n_existing:
+                samples[:n_existing] = self.matrix_samples
+            act_rows = {}
+            indices = [None] * shape[0]
+            bar = pyprind.ProgBar(len(tasks))
+            with multiprocessing.Pool(processes, initializer=_init_worker,
+                                      initargs=(self.water_key_index, shared_block, shape,
+                                                self.dtype, samples_filepath)) as pool:
+                for act_key, row_start, act_indices, error in pool.imap_unordered(
+                        _generate_samples_in_worker, tasks, chunksize=1):
+                    if error is not None:
+                        print(act_key, error)
+                    else:
+                        act_rows[row_start] = len(act_indices)
+                        indices[row_start:row_start + len(act_indices)] = act_indices
+                    bar.update()
+            # Contiguous rows of each balanced activity, in planned order.
+            # Rows of failed activities are dropped by moving the following
+            # rows up.
+            row = n_existing
+            for row_start, n_rows in sorted(act_rows.items()):
+                self.matrix_indices.extend(indices[row_start:row_start + n_rows])
+                if row_start != row:
+                    for offset in range(n_rows):
+                        samples[row + offset] = samples[row_start + offset]
+                row += n_rows
+            if samples_filepath is not None:
+                samples.flush()
+                self.samples_filepath = samples_filepath
+                samples_filepath = None
+            self.matrix_samples = samples[:row]
+        finally:
+            if samples_filepath is not None:
+                del samples
+                samples_filepath.unlink()
+
+    def schedule_acts(self):
+        """Return ActivityWaterBalancer instances of activities to balance, largest cost first
+
+        Activities with the skip strategy are not returned. Activities with
+        the same estimated cost (see `_estimate_act_cost`) are sorted by key.
+        """
+        balancers = [ab for ab in self._iter_balancers_from_data() if ab.strategy != 'skip']
+        return sorted(balancers, key=lambda ab: -self._estimate_act_cost(ab))
+
+    def _estimate_act_cost(self, ab):
+        """Return relative cost of generating samples for an activity
+
+        Sampling and balancing time grows with the number of balanced
+        exchanges, on top of a fixed per-activity overhead.
+        """
+        if ab.strategy == 'skip':
+            return 0
+        return ACT_COST_OVERHEAD + self._count_balanced_exchanges(ab)
+
+    def build_incidence_matrix(self):
+        """Build the sparse water incidence matrix of all activities in database
+
+        Strategies and balancing terms are identified from a single read of
+        the database, without modifying any activity or exchange. The
+        `WaterIncidenceMatrix` is stored in the `incidence_matrix` attribute
+        and returned.
+        """
+        self.incidence_matrix = WaterIncidenceMatrix(self._iter_balancers_from_data())
+        return self.incidence_matrix
+
+    def create_recipe(self, iterations, filepath=None, seed=None, sampling='random',
+                      block_size=RECIPE_BLOCK_SIZE):
+        """Create a recipe regenerating balanced samples on demand
+
+        Instead of generating and writing samples, only the water incidence
+        matrix of the database (see `build_incidence_matrix`) and the seed
+        are kept, and samples of the iterations used are regenerated with the
+        vectorized engine (see `WaterSampleRecipe`).
+
+        Parameters:
+        -----------
+           iterations: int
+               Number of iterations
+           filepath: str or Path, optional
+               Path of the file in which the recipe is saved
+           seed: int, optional
+               Seed of the random streams. A random seed is drawn, and stored
+               in the recipe, if not set.
+           sampling: {'random', 'lhs', 'sobol', 'antithetic'}, default='random'
+               Method used to draw uncertain water exchanges
+           block_size: int, default=RECIPE_BLOCK_SIZE
+               Number of iterations drawn from the same random stream
+
+        Returns:
+        --------
+           WaterSampleRecipe instance
+        """
+        if seed is None:
+            seed = int(np.random.SeedSequence().generate_state(1)[0])
+        recipe = WaterSampleRecipe(
+            self.build_incidence_matrix(), iterations, seed, sampling, block_size, self.dtype
+        )
+        if filepath is not None:
+            recipe.save(filepath)
+            print("Recipe written at {}".format(filepath))
+        return recipe
+
+    def verify_balance(self, dirpath=None, chunk_size=1000):
+        """Verify that samples respect the water balance of each activity
+
+        Verifies `matrix_samples` or, if `dirpath` is given, the samples of
+        written presamples packages, against the sparse water incidence
+        matrix of the database (see `WaterIncidenceMatrix.get_deviations`).
+
+        Parameters:
+        -----------
+           dirpath: str, Path or list, optional
+               Directory of a presamples package, or list of directories of
+               packages used together, e.g. a package and its static package
+               (see `create_presamples`)
+           chunk_size: int, default=1000
+               Maximum number of iterations verified at once
+
+        Returns:
+        --------
+           dict with the maximum relative deviation of each activity from
+           its static balance (`activities`), the maximum deviation over all
+           activities (`max_deviation`, infinite if samples of an activity
+           are nan or infinite) and the keys of activities whose balance
+           could not be reconstructed from samples (`unverified`).
+        """
+        incidence_matrix = self.build_incidence_matrix()
+        if dirpath is None:
+            if self.matrix_samples is None:
+                raise ValueError("No samples to verify, run `add_samples_for_all_acts` first")
+            samples, indices = self.matrix_samples, list(self.matrix_indices)
+        else:
+            samples, indices = self._load_presamples_matrix_data(dirpath, incidence_matrix.indices.keys)
+        deviations = incidence_matrix.get_deviations(samples, indices, chunk_size)
+        verified = ~np.isnan(deviations)
+        return {
+            'activities': dict(zip(incidence_matrix.act_keys, deviations.tolist())),
+            'max_deviation': float(deviations[verified].max()) if verified.any() else None,
+            'unverified': [act_key for act_key, v in zip(incidence_matrix.act_keys, verified) if not v],
+        }
+
+    def _load_presamples_matrix_data(self, dirpath, keys):
+        """Return samples and (input key, output key, matrix type) indices of presamples packages
+
+        Only rows between known `keys` are returned. `dirpath` can be a list
+        of package directories, in which case samples of single-iteration
+        packages are repeated for all iterations.
+        """
+        if isinstance(dirpath, (list, tuple)):
+            package_data = [self._load_presamples_matrix_data(path, keys) for path in dirpath]
+            iterations = max(samples.shape[1] for samples, _ in package_data)
+            return (
+                np.concatenate([
+                    np.broadcast_to(samples, (samples.shape[0], iterations)) for samples, _ in package_data
+                ], axis=0),
+                [index for _, indices in package_data for index in indices]
+            )
+        dirpath = Path(dirpath)
+        with open(dirpath / "datapackage.json", "r") as f:
+            resources = json.load(f)['resources']
+        keys_by_id = {mapping[key]: key for key in keys if key in mapping}
+        samples, indices = [], []
+        for resource in resources:
+            if resource.get('matrix') not in ['technosphere_matrix', 'biosphere_matrix']:
+                continue
+            resource_indices = np.load(dirpath / resource['indices']['filepath'])
+            resource_samples = np.load(dirpath / resource['samples']['filepath'], mmap_mode='r')
+            rows = []
+            for row, index in enumerate(resource_indices):
+                input_key = keys_by_id.get(int(index['input']))
+                output_key = keys_by_id.get(int(index['output']))
+                if input_key is None or output_key is None:
+                    continue
+                matrix_type = 'biosphere' if resource['matrix'] == 'biosphere_matrix' \
+                    else MATRIX_TYPES[int(index['type'])]
+                indices.append((input_key, output_key, matrix_type))
+                rows.append(row)
+            samples.append(resource_samples[rows])
+        if not samples:
+            raise ValueError("No technosphere or biosphere samples found in {}".format(dirpath))
+        return np.concatenate(samples, axis=0), indices
+
+    def _iter_balancers_from_data(self):
+        """Yield an ActivityWaterBalancer with identified strategy for each activity
+
+        Balancers are created from a single read of the database, and never
+        read from or write to it. Activities and their exchanges are sorted so
+        that results do not depend on the order in which they are stored.
+        """
+        db_loaded = Database(self.database_name).load()
+        for act_key in sorted(db_loaded):
+            exchanges = sorted(
+                db_loaded[act_key].get('exchanges', []),
+                key=lambda exc: (exc['input'], exc.get('type', ''))
+            )
+            ab = ActivityWaterBalancer.from_exchange_data(act_key, exchanges, self.water_key_index)
+            if getattr(ab, 'strategy', None) is None:
+                ab._identify_strategy()
+            yield ab
+
+    def _allocate_sample_buffer(self, n_rows, iterations, memory_limit=None, spill_dirpath=None):
+        """Preallocate storage for `n_rows` more rows of samples
+
+        Samples are stored in memory if there is no `memory_limit`.
+        """
+        n_existing = 0
+        if self.matrix_samples is not None:
+            if self.matrix_samples.shape[1] != iterations:
+                raise ValueError("Existing samples have {} iterations, not {}".format(
+                    self.matrix_samples.shape[1], iterations
+                ))
+            n_existing = self.matrix_samples.shape[0]
+        shape = (n_existing + n_rows, iterations)
+        if memory_limit is None or shape[0] * shape[1] * self.dtype.itemsize <= memory_limit // 2:
+            buffer = np.empty(shape, dtype=self.dtype)
+        else:
+            spill_dirpath = Path(spill_dirpath or tempfile.mkdtemp())
+            self.samples_filepath = spill_dirpath / "{}.samples.npy".format(uuid.uuid4().hex)
+            buffer = np.lib.format.open_memmap(
+                self.samples_filepath, mode='w+', dtype=self.dtype, shape=shape
+            )
+        if n_existing:
+            buffer[:n_existing] = self.matrix_samples
+        self._sample_buffer = buffer
+        self._buffer_cursor = n_existing
+        self._flush_nbytes = None if memory_limit is None else memory_limit // 4
+        self._unflushed_nbytes = 0
+
+    def _store_samples(self, samples):
+        """Append samples to matrix_samples, in the preallocated buffer if any"""
+        # Samples are balanced in float64, only downcast when stored
+        samples = samples.astype(self.dtype, copy=False)
+        if self._sample_buffer is None:
+            if self.matrix_samples is None:
+                self.matrix_samples = samples
+            else:
+                self.matrix_samples = np.concatenate(
+                    [self.matrix_samples, samples], axis=0
+                )
+            return
+        end = self._buffer_cursor + samples.shape[0]
+        if end > self._sample_buffer.shape[0]:
+            raise ValueError("More samples than planned: {} rows for {} planned".format(
+                end, self._sample_buffer.shape[0]
+            ))
+        self._sample_buffer[self._buffer_cursor:end] = samples
+        self._buffer_cursor = end
+        self.matrix_samples = self._sample_buffer[:end]
+        self._flush_sample_buffer(samples.nbytes)
+
+    def _flush_sample_buffer(self, nbytes):
+        """Flush buffer streamed to disk every `_flush_nbytes` written bytes"""
+        self._unflushed_nbytes += nbytes
+        if isinstance(self._sample_buffer, np.memmap) and self._unflushed_nbytes >= self._flush_nbytes:
+            self._sample_buffer.flush()
+            self._unflushed_nbytes = 0
+
+    def _release_sample_buffer(self):
+        """Stop writing to the preallocated buffer, keeping the stored samples"""
+        if self._sample_buffer is None:
+            return
+        if isinstance(self._sample_buffer, np.memmap):
+            self._sample_buffer.flush()
+        if self._buffer_cursor:
+            self.matrix_samples = self._sample_buffer[:self._buffer_cursor]
+        self._sample_buffer = None
+
+    def plan(self, iterations, dtype=None, calibration_size=5, engine='parameters'):
+        """Plan sample generation for all activities without sampling
+
+        Strategies are identified from a single read of the database, without
+        modifying any activity or exchange. The runtime is estimated by timing
+        sample generation with `engine` for a few activities that are not
+        skipped. Other engines balance the exchange data already read (see
+        `ActivityWaterBalancer.from_exchange_data`). The parameters engine
+        writes to the database: its changes are rolled back (see
+        `_rolled_back_changes`), so that planning leaves the database as it
+        was.
+
+        Parameters:
+        -----------
+           iterations: int
+               Number of iterations in planned samples
+           dtype: numpy floating dtype, optional
+               Data type of planned samples. Defaults to the balancer dtype.
+           calibration_size: int, default=5
+               Number of activities for which samples are actually generated
+               to estimate runtime. No runtime is estimated if 0.
+           engine: {'parameters', 'pipelined', 'parallel', 'vectorized'}, default='parameters'
+               Engine whose runtime is estimated, see `add_samples_for_all_acts`.
+               Runtimes are estimated for a single process, and activity by
+               activity for the vectorized engine.
+
+        Returns:
+        --------
+           dict with the number of activities per strategy (`strategies`),
+           number of balanced exchanges (`exchanges`), expected size of
+           `matrix_samples` in bytes (`matrix_samples_nbytes`), estimated
+           runtime in seconds (`estimated_seconds`) and the strategy,
+           number of balanced exchanges and estimated relative cost for each
+           activity (`activities`).
+        """
+        if engine not in ['parameters', 'pipelined', 'parallel', 'vectorized']:
+            raise ValueError("Unknown engine {}".format(engine))
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        strategies = {'skip': 0, 'set_static': 0, 'inverse': 0, 'default': 0}
+        activities = {}
+        balancers = {}
+        for ab in self._iter_balancers_from_data():
+            balancers[ab.act_key] = ab
+            strategies[ab.strategy] += 1
+            activities[ab.act_key] = {
+                'strategy': ab.strategy,
+                'exchanges': self._count_balanced_exchanges(ab),
+                'cost': self._estimate_act_cost(ab),
+            }
+        n_exchanges = sum(act['exchanges'] for act in activities.values())
+
+        estimated_seconds = None
+        to_balance = [k for k, v in activities.items() if v['strategy'] != 'skip']
+        if calibration_size and to_balance:
+            step = max(1, len(to_balance) // calibration_size)
+            timings = []
+            with self._rolled_back_changes(engine == 'parameters'):
+                for act_key in to_balance[::step][:calibration_size]:
+                    start = time.perf_counter()
+                    try:
+                        if engine == 'parameters':
+                            ActivityWaterBalancer(act_key, self).generate_samples(iterations)
+                        else:
+                            balancers[act_key].generate_samples(iterations)
+                    except Exception as err:
+                        print(act_key, str(err))
+                        continue
+                    timings.append(time.perf_counter() - start)
+            if timings:
+                estimated_seconds = float(np.mean(timings)) * len(to_balance)
+
+        return {
+            'strategies': strategies,
+            'exchanges': n_exchanges,
+            'iterations': iterations,
+            'dtype': str(dtype),
+            'matrix_samples_nbytes': n_exchanges * iterations * dtype.itemsize,
+            'estimated_seconds': estimated_seconds,
+            'activities': activities,
+        }
+
+    @contextmanager
+    def _rolled_back_changes(self, roll_back=True):
+        """Roll back changes to activities, exchanges, parameters and database metadata
+
+        Changes made in the context are made in transactions of the LCI and
+        parameters databases that are rolled back on exit, and the metadata
+        of the database, e.g. its modification time, are restored.
+        """
+        if not roll_back:
+            yield
+            return
+        metadata = copy.deepcopy(databases[self.database_name])
+        with sqlite3_lci_db.transaction() as lci_transaction, \
+                parameters.db.transaction() as parameters_transaction:
+            try:
+                yield
+            finally:
+                parameters_transaction.rollback()
+                lci_transaction.rollback()
+                databases[self.database_name] = metadata
+
+    def _count_balanced_exchanges(self, ab):
+        """Return number of exchanges for which an ActivityWaterBalancer generates samples"""
+        if ab.strategy == 'skip':
+            return 0
+        if ab.strategy == 'set_static':
+            return 1
+        return len([t for t in ab.water_exchange_types if t in IN_EXC_TYPES + OUT_EXC_TYPES])
 
     def create_presamples(self, name=None, id_=None, overwrite=False, dirpath=None,
-                            seed='sequential'):
+                            seed='sequential', iterations=None, compress_constant_rows=False,
+                            duplicates='merge'):
         """Create a presamples package from generated samples
 
+        Package indices are sorted by matrix and matrix position, and are
+        unique: samples of the same matrix cell are merged in the package
+        as by `sort_samples`. To write samples of each matrix without
+        copying them, rows of `matrix_samples` and `matrix_indices` are
+        reordered in place, their samples being left unchanged.
+
         Parameters
         -----------
            name: str, optional
@@ -169,48 +1255,126 @@ class DatabaseWaterBalancer():
                An optional directory path where presamples can be created. If None, a subdirectory in the ``project`` folder.
            seed: {None, int, "sequential"}, optional, default="sequential"
                Seed used by indexer to return array columns in random order. Can be an integer, "sequential" or None.
+           iterations: list, optional
+               Numbers of iterations of packages to write. Each package holds
+               the first iterations of the generated samples, so smaller
+               packages are nested in larger ones. ``name`` and ``\id_``
+               are suffixed with the number of iterations. Prefixes of Latin
+               hypercube samples are not stratified, and prefixes of
+               antithetic samples should have even numbers of iterations.
+           compress_constant_rows: bool, default=False
+               If True, samples that are the same in all iterations (e.g.
+               exchanges of activities with the set_static strategy, or
+               certain exchanges of other activities) are written once, in
+               a separate single-iteration package whose ``\id_`` and
+               ``name`` are suffixed with "static". Both packages are then
+               passed to the LCA. Rows of a matrix cell are only moved to
+               the static package if all rows of the cell are constant.
+           duplicates: {'merge', 'raise'}, default='merge'
+               Whether to merge samples of the same matrix cell in the
+               package or raise a ValueError
+
+        Returns:
+        --------
+           (id_, dirpath) of the package, or a dict with the (id_, dirpath)
+           of the package of each number of `iterations` if given. If
+           `compress_constant_rows`, a tuple with this result and the
+           (id_, dirpath) of the static package, either being None if there
+           are no such samples.
         """
+        return self.write_samples(
+            'presamples', duplicates=duplicates, name=name, id_=id_, overwrite=overwrite,
+            dirpath=dirpath, seed=seed, iterations=iterations,
+            compress_constant_rows=compress_constant_rows
+        )
+
+    def sort_samples(self, duplicates='merge'):
+        """Sort samples in place by matrix and matrix position, merging samples of the same cell
+
+        Biosphere rows of `matrix_samples` and `matrix_indices` are put
+        before technosphere rows, each sorted by (row, column) position in
+        the LCA matrices, i.e. by ids of the Brightway2 mapping. Samples of
+        the same matrix cell are merged as in presamples packages: samples
+        of the same type are summed, and technosphere samples of a cell with
+        production samples are subtracted from them. Rows are permuted and
+        merged in place, without copying samples. Activities whose merged
+        exchanges had different roles can then no longer be verified, see
+        `verify_balance`.
+
+        Writing samples does not require this: packages are written with
+        merged cells whether or not samples were sorted.
+
+        Parameters:
+        -----------
+           duplicates: {'merge', 'raise'}, default='merge'
+               Whether to merge samples of the same matrix cell or raise a
+               ValueError
+
+        Returns:
+        --------
+           Number of merged rows
+        """
+        if self.matrix_samples is None or not len(self.matrix_indices):
+            return 0
+        if duplicates not in ('merge', 'raise'):
+            raise ValueError("Unknown duplicates handling {}, use 'merge' or 'raise'".format(duplicates))
+        n_rows = len(self.matrix_indices)
+        n_cells = self.matrix_indices.sort(self.matrix_samples, np.array(_get_node_ids(self.matrix_indices.keys)))
+        if n_cells < n_rows and duplicates == 'raise':
+            raise ValueError("Several samples for matrix cell of index {}".format(self.matrix_indices[n_cells]))
+        self.matrix_indices, _, _ = self.matrix_indices.merge_duplicates(self.matrix_samples, n_cells)
+        self.matrix_samples = self.matrix_samples[:n_cells]
+        return n_rows - n_cells
+
+    def write_samples(self, backend='presamples', **kwargs):
+        """Write generated samples with an output backend
+
+        Parameters:
+        -----------
+           backend: str or object, default='presamples'
+               Name of an output backend in `OUTPUT_BACKENDS`:
+                   * 'presamples': presamples packages, see `create_presamples`
+                   * 'datapackage': bw_processing datapackage, as used by
+                     bw2calc 2, see `DatapackageBackend.write`
+               or any object with a `write(matrix_indices, samples, **kwargs)`
+               method.
+           kwargs:
+               Passed to the `write` method of the backend
+
+        Returns:
+        --------
+           Value returned by the backend, usually the id and path of written
+           samples
+        """
+        backend = get_output_backend(backend)
         if not all([self.matrix_samples is not None, self.matrix_indices]):
-            warnings.warn("No presamples created because there were no matrix data. "
+            warnings.warn("No samples written because there were no matrix data. "
                       "Make sure to run `add_samples_for_all_acts` or "
                       "`add_samples_for_act` for a set of acts first.")
             return
+        return backend.write(self.matrix_indices, self.matrix_samples, **kwargs)
+
+    def get_presamples_loader(self, seed='sequential', lca=None):
+        """Return a presamples data loader of generated samples, without writing a package
 
-        id_, dirpath = create_presamples_package(
-            matrix_data=split_inventory_presamples(self.matrix_samples, self.matrix_indices),
-            name=name, id_=id_, overwrite=overwrite, dirpath=dirpath, seed=seed)
-        print("Presamples with id_ {} written at {}".format(id_, dirpath))
-        return id_, dirpath
+        The loader can be attached to an LCA or Monte Carlo LCA of the same
+        process (see `InMemoryPresamplesLoader`), which then uses samples as
+        if they were read from the package written by `create_presamples`.
+
+        Parameters:
+        -----------
+           seed: {None, int, "sequential"}, optional, default="sequential"
+               Seed used by indexer to return array columns in random order
+           lca: Brightway2 LCA object, optional
+               LCA using the samples
+        """
+        if self.matrix_samples is None or not len(self.matrix_indices):
+            raise ValueError("No samples, run `add_samples_for_all_acts` first")
+        return InMemoryPresamplesLoader(self.matrix_indices, self.matrix_samples, seed=seed, lca=lca)
 
     def _identify_bio_keys(self):
         """Identify keys of water biosphere exchanges to consider in balancing"""
-
-        bio_loaded = Database(self.biosphere).load()
-        input_bio_keys = []
-        output_bio_keys = []
-        for ef_key, ef in pyprind.prog_bar(bio_loaded.items()):
-            if not "Water" in ef['name']:
-                continue
-            if not self._check_bio_exc_used_by_database(ef_key):
-                continue
-            if ef.get('type') == 'natural resource':
-                input_bio_keys.append(ef_key)
-            elif ef.get('type') == 'emission':
-                output_bio_keys.append(ef_key)
-            else:
-                warnings.warn("Elementary flow type not understood for {}".format(ef))
-        return input_bio_keys, output_bio_keys
-
-    def _check_bio_exc_used_by_database(self, ef_key):
-        """ Identify if biosphere exchanges used in database"""
-
-        q = ExchangeDataset.select().where(ExchangeDataset.input_code == ef_key[1])
-        if len(q) == 0:
-            return False
-        q2 = q.select().where(ExchangeDataset.output_database == self.database_name)
-        if len(q2) == 0:
-            return False
-        return True
+        return identify_bio_water_keys(self.biosphere, [self.database_name])[self.database_name]
 
     def _identify_techno_keys(self):
         """Identify keys of activities with water production exchanges
@@ -0,0 +1,120 @@
+import numpy as np
+import warnings
+from presamples import PackagesDataLoader
+from presamples.indexer import Indexer
+from presamples.packaging import format_matrix_data
+from .matrix_indices import MATRIX_TYPE_CODES
+
+
+class InMemorySamplesArray():
+    """Samples of matrix cells with the interface of `presamples.RegularPresamplesArrays`
+
+    Samples of each iteration are taken from generated samples (an array
+    or a `WaterSampleRecipe`) and collapsed by matrix cell when requested.
+
+    Parameters:
+    -----------
+    samples: numpy.ndarray or WaterSampleRecipe
+        Samples (rows x iterations) of generated rows
+    cell_matrix: scipy.sparse.csr_matrix
+        Sparse (cells x rows) matrix collapsing rows of samples by cell
+    """
+    def __init__(self, samples, cell_matrix):
+        self.samples = samples
+        self.cell_matrix = cell_matrix
+        self.count = 0
+
+    def sample(self, index):
+        """Return samples of all cells for iteration `index`"""
+        if hasattr(self.samples, 'generate'):
+            column = self.samples.generate(index, index + 1)[:, 0]
+        else:
+            column = self.samples[:, index]
+        self.count += 1
+        return self.cell_matrix @ np.asarray(column, dtype=np.float64)
+
+
+class InMemoryPresamplesLoader(PackagesDataLoader):
+    """Presamples data loader of balanced samples held in memory
+
+    Exposes generated samples as the matrix data of a single presamples
+    package, so that an LCA or Monte Carlo LCA of the same process uses them
+    without writing and reading a package. Samples are collapsed by matrix
+    cell as when written by `create_presamples_package`, one iteration at a
+    time when the LCA matrices are updated.
+
+    Usually created by `DatabaseWaterBalancer.get_presamples_loader`, and
+    attached to an LCA with `attach`::
+
+        mc = MonteCarloLCA(demand, method)
+        dwb.get_presamples_loader().attach(mc)
+
+    Parameters:
+    -----------
+    matrix_indices: MatrixIndices
+        (input key, output key, matrix type) index of each row of samples
+    samples: numpy.ndarray or WaterSampleRecipe
+        Samples (rows x iterations). Samples of a recipe are only generated
+        for the iterations used.
+    seed: {None, int, "sequential"}, default="sequential"
+        Seed used by the indexer to return columns in random order
+    name: str, default="in-memory water samples"
+        Name of the package
+    lca: Brightway2 LCA object, optional
+        LCA using the samples
+    """
+    def __init__(self, matrix_indices, samples, seed='sequential', name="in-memory water samples", lca=None):
+        if hasattr(samples, 'generate'):
+            n_rows, ncols = len(samples), samples.iterations
+            if seed != 'sequential' and samples.n_blocks > samples.cache_size:
+                warnings.warn("Iterations of the recipe are used in random order: each iteration "
+                              "may regenerate a block of {} iterations. Use seed='sequential' or a "
+                              "cache_size of at least {} blocks".format(samples.block_size, samples.n_blocks))
+        else:
+            n_rows, ncols = samples.shape
+        if len(matrix_indices) != n_rows:
+            raise ValueError("Shape mismatch: {} indices for {} rows of samples".format(len(matrix_indices), n_rows))
+        self.seed, self.dirpaths = seed, [name]
+        self.matrix_data_loaded, self.parameter_data_loaded = [], []
+        self.package_indexers, self.matrix_indexer = [], []
+        self.lca_reference = lca
+
+        cells, cell_matrix = matrix_indices.collapse()
+        biosphere = cells.array['type'] == MATRIX_TYPE_CODES['biosphere']
+        matrix_data = []
+        for kind, mask in [('biosphere', biosphere), ('technosphere', ~biosphere)]:
+            if not mask.any():
+                continue
+            kind_cells = cells.select(mask)
+            indices = [index if kind == 'technosphere' else index[:2] for index in kind_cells]
+            array, metadata = format_matrix_data(indices, kind)
+            elem = dict(metadata)
+            elem.update({
+                'type': kind,
+                'indices': array,
+                'samples': InMemorySamplesArray(samples, cell_matrix[np.flatnonzero(mask)]),
+            })
+            matrix_data.append(elem)
+        indexer = Indexer(ncols, seed)
+        self.package_indexers.append(indexer)
+        if matrix_data:
+            self.matrix_data_loaded.append({
+                'name': name, 'path': None, 'id': name, 'seed': seed, 'ncols': ncols,
+                'matrix-data': matrix_data, 'indexer': indexer,
+            })
+            self.matrix_indexer.append(indexer)
+        self.empty = not bool(self.matrix_data_loaded)
+        self.update_package_indices()
+
+    def attach(self, lca):
+        """Use samples in `lca`, replacing its presamples, and return `lca`
+
+        Matrices of an LCA whose inventory data are already loaded are
+        updated immediately.
+        """
+        lca.presamples = self
+        self.lca_reference = lca
+        if hasattr(lca, 'technosphere_matrix'):
+            self.index_arrays(lca)
+            self.update_matrices(lca, matrices=('technosphere_matrix', 'biosphere_matrix'))
+        return lca
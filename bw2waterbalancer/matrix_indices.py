@@ -0,0 +1,338 @@
+import numpy as np
+from scipy import sparse
+
+# Matrix type codes, as used by bw2calc and presamples
+MATRIX_TYPE_CODES = {
+    'production': 0,
+    'technosphere': 1,
+    'biosphere': 2,
+}
+MATRIX_TYPES = {code: matrix_type for matrix_type, code in MATRIX_TYPE_CODES.items()}
+
+INDICES_DTYPE = np.dtype([
+    ('input', np.uint32),
+    ('output', np.uint32),
+    ('type', np.uint8),
+])
+
+
+class MatrixIndices():
+    """Compact, growable store of matrix indices of samples
+
+    Each (input key, output key, matrix type) index is stored as a row of a
+    NumPy structured array holding integer ids of the keys and a matrix type
+    code (see `MATRIX_TYPE_CODES`). Keys are only resolved back to tuples when
+    iterating or when handing indices off to presamples.
+
+    Parameters:
+    -----------
+    indices: iterable, optional
+        Initial (input key, output key, matrix type) indices
+
+    Attributes:
+    -----------
+    keys: list
+        Keys of activities and elementary flows, by id
+    array: numpy.ndarray
+        Structured array of stored indices, with fields 'input', 'output'
+        and 'type'
+    """
+    def __init__(self, indices=None):
+        self.keys = []
+        self._key_ids = {}
+        self._array = np.empty(0, dtype=INDICES_DTYPE)
+        self._length = 0
+        if indices is not None:
+            self.extend(indices)
+
+    @classmethod
+    def from_array(cls, keys, array):
+        """Create instance from keys and a structured array of key ids, as in `keys` and `array`"""
+        matrix_indices = cls()
+        for key in keys:
+            matrix_indices._get_key_id(key)
+        matrix_indices._array = np.asarray(array).astype(INDICES_DTYPE)
+        matrix_indices._length = len(matrix_indices._array)
+        return matrix_indices
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for input_id, output_id, type_code in self.array.tolist():
+            yield (self.keys[input_id], self.keys[output_id], MATRIX_TYPES[type_code])
+
+    def __getitem__(self, position):
+        input_id, output_id, type_code = self.array[position].tolist()
+        return (self.keys[input_id], self.keys[output_id], MATRIX_TYPES[type_code])
+
+    @property
+    def array(self):
+        return self._array[:self._length]
+
+    def _get_key_id(self, key):
+        """Return id of key, adding it to known keys if needed"""
+        key_id = self._key_ids.get(key)
+        if key_id is None:
+            key_id = self._key_ids[key] = len(self.keys)
+            self.keys.append(key)
+        return key_id
+
+    def _reserve(self, n_rows):
+        """Make room for `n_rows` more indices, doubling capacity if needed"""
+        needed = self._length + n_rows
+        if needed > len(self._array):
+            array = np.empty(max(needed, 2 * len(self._array)), dtype=INDICES_DTYPE)
+            array[:self._length] = self.array
+            self._array = array
+
+    def append(self, index):
+        """Add a (input key, output key, matrix type) index"""
+        self.extend([index])
+
+    def extend(self, indices, matrix_type=None):
+        """Add indices
+
+        Parameters:
+        -----------
+           indices: iterable
+               (input key, output key, matrix type) indices, or another
+               MatrixIndices instance. If `matrix_type` is given, (input key,
+               output key) pairs instead.
+           matrix_type: str, optional
+               Matrix type of all indices
+        """
+        if isinstance(indices, MatrixIndices):
+            key_ids = np.array([self._get_key_id(key) for key in indices.keys], dtype=np.uint32)
+            rows = indices.array.copy()
+            if len(key_ids):
+                rows['input'] = key_ids[rows['input']]
+                rows['output'] = key_ids[rows['output']]
+        else:
+            indices = list(indices)
+            rows = np.empty(len(indices), dtype=INDICES_DTYPE)
+            rows['input'] = [self._get_key_id(index[0]) for index in indices]
+            rows['output'] = [self._get_key_id(index[1]) for index in indices]
+            rows['type'] = [MATRIX_TYPE_CODES[matrix_type or index[2]] for index in indices]
+        self._reserve(len(rows))
+        self._array[self._length:self._length + len(rows)] = rows
+        self._length += len(rows)
+
+    def select(self, rows):
+        """Return new MatrixIndices with indices at positions or boolean mask `rows`"""
+        selected = MatrixIndices()
+        selected.keys = list(self.keys)
+        selected._key_ids = dict(self._key_ids)
+        selected._array = self.array[rows].copy()
+        selected._length = len(selected._array)
+        return selected
+
+    def reorder(self, order, samples=None):
+        """Reorder indices in place, and the rows of `samples` with them
+
+        Rows of `samples` are permuted in place, with a single row of extra
+        memory, so that large samples (including memory-mapped samples) are
+        not copied. Read-only samples are not supported.
+
+        Parameters:
+        -----------
+           order: numpy.ndarray
+               Current position of each index in the new order
+           samples: numpy.ndarray, optional
+               Samples (rows x iterations) of the indices
+        """
+        order = np.asarray(order, dtype=np.int64)
+        if len(order) != len(self):
+            raise ValueError("Shape mismatch: {} positions, {} indices".format(len(order), len(self)))
+        if samples is not None:
+            if samples.shape[0] != len(self):
+                raise ValueError("Shape mismatch: {} samples, {} indices".format(samples.shape[0], len(self)))
+            _permute_rows(samples, order)
+        self._array[:self._length] = self.array[order]
+
+    def sort(self, samples, positions=None, groups=None):
+        """Sort indices and rows of samples in place by matrix cell
+
+        Rows are sorted by `groups` if given, then biosphere rows come
+        before technosphere rows, each sorted by (row, column) position in
+        the matrix. Rows of a matrix cell (see `get_cell_ids`) other than
+        its first row are moved after the first rows of all cells, so that
+        the first `n` rows have sorted and unique cells. Rows are permuted
+        in place, see `reorder`, and their samples are not changed.
+
+        Parameters:
+        -----------
+           samples: numpy.ndarray
+               Writable samples (rows x iterations) of the indices
+           positions: numpy.ndarray, optional
+               Matrix position (e.g. id in the Brightway2 mapping) of each of
+               `keys`. Defaults to the position of keys in `keys`.
+           groups: numpy.ndarray, optional
+               Sort key of each row, the same for all rows of a cell
+
+        Returns:
+        --------
+           Number of matrix cells `n`
+        """
+        if samples.shape[0] != len(self):
+            raise ValueError("Shape mismatch: {} samples, {} indices".format(samples.shape[0], len(self)))
+        positions = np.arange(len(self.keys)) if positions is None else np.asarray(positions)
+        array = self.array
+        first_rows = self._get_first_rows(self.get_cell_ids())
+        is_duplicate = np.ones(len(self), dtype=bool)
+        is_duplicate[first_rows] = False
+        keys = [
+            positions[array['output']],
+            positions[array['input']],
+            array['type'] != MATRIX_TYPE_CODES['biosphere'],
+        ]
+        if groups is not None:
+            keys.append(groups)
+        self.reorder(np.lexsort(keys + [is_duplicate]), samples)
+        return len(first_rows)
+
+    def merge_duplicates(self, samples, n_cells):
+        """Add samples of duplicate rows to the first row of their cell, in place
+
+        Indices must be sorted with `sort`, which returned `n_cells`.
+        Samples of rows after the first `n_cells` rows are merged as in
+        `collapse`: samples of the same type are summed, and technosphere
+        samples of a cell with production samples are subtracted from them.
+        Indices are not modified, and the original samples of modified rows
+        are returned so that they can be restored.
+
+        Returns:
+        --------
+           (MatrixIndices of the first `n_cells` rows, with the type of the
+           merged cells, positions of modified rows, original samples of
+           modified rows)
+        """
+        array = self.array
+        cell_ids = self.get_cell_ids()
+        n_rows = len(self)
+        first_rows = self._get_first_rows(cell_ids)
+        if len(first_rows) != n_cells or (np.sort(first_rows) != np.arange(n_cells)).any():
+            raise ValueError("Indices are not sorted by matrix cell, use `sort` first")
+        targets = first_rows[cell_ids]
+        is_production = array['type'] == MATRIX_TYPE_CODES['production']
+        with_production = np.bincount(cell_ids, weights=is_production) > 0
+        is_technosphere = array['type'] == MATRIX_TYPE_CODES['technosphere']
+        signs = np.where(is_technosphere & with_production[cell_ids], -1., 1.)
+        modified = np.unique(targets[n_cells:])
+        original = np.array(samples[modified])
+        samples[modified] = original * signs[modified].reshape(-1, 1)
+        for row in range(n_cells, n_rows):
+            samples[targets[row]] += signs[row] * samples[row]
+        cells = self.select(slice(0, n_cells))
+        cells._array['type'][with_production[cell_ids[:n_cells]]] = MATRIX_TYPE_CODES['production']
+        return cells, modified, original
+
+    def _get_first_rows(self, cell_ids):
+        """Return position of the first row of each cell"""
+        n_cells = int(cell_ids.max()) + 1 if len(cell_ids) else 0
+        first_rows = np.full(n_cells, len(self), dtype=np.int64)
+        np.minimum.at(first_rows, cell_ids, np.arange(len(self)))
+        return first_rows
+
+    def get_cell_ids(self):
+        """Return id of the matrix cell of each index
+
+        Production and technosphere indices of the same (input, output) pair
+        share a cell, as they are collapsed by presamples.
+        """
+        array = self.array
+        cells = np.empty(len(self), dtype=[('input', np.uint32), ('output', np.uint32), ('biosphere', bool)])
+        cells['input'] = array['input']
+        cells['output'] = array['output']
+        cells['biosphere'] = array['type'] == MATRIX_TYPE_CODES['biosphere']
+        return np.unique(cells, return_inverse=True)[1].ravel()
+
+    def collapse(self):
+        """Return indices of matrix cells, and sparse matrix summing samples of each cell
+
+        Rows of samples of the same matrix cell (see `get_cell_ids`) are
+        collapsed as in presamples packages: samples of the same type are
+        summed, and technosphere samples of a cell with production samples
+        are subtracted from them, the cell having the production type.
+
+        Returns:
+        --------
+           (MatrixIndices of cells, scipy.sparse.csr_matrix (cells x indices))
+        """
+        array = self.array
+        cell_ids = self.get_cell_ids()
+        first_rows = self._get_first_rows(cell_ids)
+        n_cells = len(first_rows)
+        is_production = array['type'] == MATRIX_TYPE_CODES['production']
+        with_production = np.bincount(cell_ids, weights=is_production, minlength=n_cells) > 0
+        is_technosphere = array['type'] == MATRIX_TYPE_CODES['technosphere']
+        signs = np.where(is_technosphere & with_production[cell_ids], -1., 1.)
+        cells = self.select(first_rows)
+        cells._array['type'][with_production] = MATRIX_TYPE_CODES['production']
+        return cells, sparse.csr_matrix((signs, (cell_ids, np.arange(len(self)))), shape=(n_cells, len(self)))
+
+    def split_samples(self, samples):
+        """Split samples and indices in biosphere and technosphere matrix data
+
+        Equivalent to `presamples.split_inventory_presamples`, using masks on
+        matrix type codes rather than comparing each index. If rows of each
+        matrix are contiguous (see `reorder`), samples of each matrix are
+        views of `samples` rather than copies.
+        """
+        if samples.shape[0] != len(self):
+            raise ValueError("Shape mismatch: {} samples, {} indices".format(samples.shape[0], len(self)))
+        array = self.array
+        mask = array['type'] == MATRIX_TYPE_CODES['biosphere']
+        biosphere_rows, technosphere_rows = _get_rows(mask), _get_rows(~mask)
+        keys = np.empty(len(self.keys), dtype=object)
+        for key_id, key in enumerate(self.keys):
+            keys[key_id] = key
+        matrix_data = []
+        if mask.any():
+            matrix_data.append((
+                samples[biosphere_rows, :],
+                list(zip(keys[array['input'][mask]], keys[array['output'][mask]])),
+                "biosphere"
+            ))
+        if (~mask).any():
+            types = np.array([MATRIX_TYPES[code] for code in range(len(MATRIX_TYPES))], dtype=object)
+            matrix_data.append((
+                samples[technosphere_rows, :],
+                list(zip(
+                    keys[array['input'][~mask]],
+                    keys[array['output'][~mask]],
+                    types[array['type'][~mask]]
+                )),
+                "technosphere"
+            ))
+        return matrix_data
+
+
+def _get_rows(mask):
+    """Return slice of rows selected by boolean `mask` if they are contiguous, else `mask`"""
+    rows = np.flatnonzero(mask)
+    if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+        return slice(int(rows[0]), int(rows[-1]) + 1)
+    return mask
+
+
+def _permute_rows(array, order):
+    """Permute rows of `array` in place so that row i is the former row `order[i]`
+
+    Each cycle of the permutation is followed with a single row held aside,
+    rather than copying the array.
+    """
+    done = order == np.arange(len(order))
+    for start in np.flatnonzero(~done):
+        if done[start]:
+            continue
+        row = np.array(array[start])
+        position = start
+        while True:
+            done[position] = True
+            source = order[position]
+            if source == start:
+                array[position] = row
+                break
+            array[position] = array[source]
+            position = source
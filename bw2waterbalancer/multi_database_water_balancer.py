@@ -0,0 +1,148 @@
+from brightway2 import *
+import numpy as np
+import warnings
+from .database_water_balancer import DatabaseWaterBalancer, identify_bio_water_keys
+from .matrix_indices import MatrixIndices
+from .output_backends import PresamplesBackend
+
+
+class MultiDatabaseWaterBalancer():
+    """Generate balanced water samples for several LCI databases sharing a biosphere
+
+    Developed to balance several system models of the same ecoinvent release
+    (e.g. cutoff, APOS and consequential) in one pass. Water elementary flows
+    of the biosphere database are classified once and their use by all
+    databases is found with a single query (see `identify_bio_water_keys`).
+    Each database is then balanced by its own `DatabaseWaterBalancer`.
+
+    Parameters:
+    -----------
+    ecoinvent_version: string
+        ecoinvent release number, see `DatabaseWaterBalancer`
+    database_names: list
+        Names of the LCI databases in the brightway2 project
+    biosphere: string, default='biosphere3'
+        Name of the biosphere database in the brighway2 database
+    group: string, default='water'
+        Name of the parameter group name. Used in the generation of samples.
+    dtype: numpy floating dtype, default=np.float64
+        Data type used to store and write samples
+    unit_conversions: dict, optional
+        Factors converting water exchange amounts to kg, by unit name
+
+    Attributes:
+    -----------
+    database_names: list
+        Names of the LCI databases in the brightway2 project
+    biosphere: string
+        Name of the biosphere database in the brighway2 database
+    balancers: dict
+        DatabaseWaterBalancer instance of each database
+    """
+    def __init__(self, ecoinvent_version, database_names, biosphere='biosphere3', group="water",
+                 dtype=np.float64, unit_conversions=None):
+        print("Validating data")
+        for database_name in list(database_names) + [biosphere]:
+            if database_name not in databases:
+                raise ValueError("Database {} not imported".format(database_name))
+        if len(set(database_names)) != len(database_names):
+            raise ValueError("Database names must be unique")
+        self.database_names = list(database_names)
+        self.biosphere = biosphere
+
+        print("Getting information on biosphere water exchanges")
+        bio_keys = identify_bio_water_keys(biosphere, self.database_names)
+        self.balancers = {
+            database_name: DatabaseWaterBalancer(
+                ecoinvent_version, database_name, biosphere=biosphere, group=group,
+                dtype=dtype, unit_conversions=unit_conversions,
+                bio_keys=bio_keys[database_name]
+            )
+            for database_name in self.database_names
+        }
+
+    def __getitem__(self, database_name):
+        return self.balancers[database_name]
+
+    def add_samples_for_all_acts(self, iterations, **kwargs):
+        """Add samples and indices for all activities of all databases
+
+        Keyword arguments are passed to
+        `DatabaseWaterBalancer.add_samples_for_all_acts`.
+        """
+        for database_name in self.database_names:
+            print("Generating samples for database {}".format(database_name))
+            self.balancers[database_name].add_samples_for_all_acts(iterations, **kwargs)
+
+    def create_presamples(self, name=None, id_=None, overwrite=False, dirpath=None,
+                          seed='sequential', combined=False, iterations=None,
+                          compress_constant_rows=False, duplicates='merge'):
+        """Create presamples packages from generated samples
+
+        Parameters
+        -----------
+           name: str, optional
+               A human-readable name for these samples. Suffixed with the
+               database name for packages of individual databases.
+           id_: str, optional
+               Unique id for this collection of presamples. Suffixed with the
+               database name for packages of individual databases.
+           overwrite: bool, default=False
+               If True, replace existing presamples packages with the same ids
+           dirpath: str, optional
+               An optional directory path where presamples can be created
+           seed: {None, int, "sequential"}, optional, default="sequential"
+               Seed used by indexer to return array columns in random order
+           combined: bool, default=False
+               If True, write a single package with the samples of all
+               databases
+           iterations: list, optional
+               Numbers of iterations of nested packages to write, see
+               `DatabaseWaterBalancer.create_presamples`
+           compress_constant_rows: bool, default=False
+               If True, write constant samples in separate static packages,
+               see `DatabaseWaterBalancer.create_presamples`
+           duplicates: {'merge', 'raise'}, default='merge'
+               Whether to merge samples of the same matrix cell in packages
+               or raise a ValueError
+
+        Returns:
+        --------
+           (id_, dirpath) of the combined package if `combined`, otherwise a
+           dict with the (id_, dirpath) of the package of each database with
+           samples. With `iterations`, each (id_, dirpath) is replaced by a
+           dict with the (id_, dirpath) of each number of iterations. With
+           `compress_constant_rows`, each result is a tuple with the result
+           of varying samples and the (id_, dirpath) of the static package.
+        """
+        with_samples = [
+            database_name for database_name in self.database_names
+            if self.balancers[database_name].matrix_samples is not None
+            and len(self.balancers[database_name].matrix_indices)
+        ]
+        if not combined:
+            packages = {}
+            for database_name in with_samples:
+                packages[database_name] = self.balancers[database_name].create_presamples(
+                    name=None if name is None else "{} - {}".format(name, database_name),
+                    id_=None if id_ is None else "{}_{}".format(id_, database_name),
+                    overwrite=overwrite, dirpath=dirpath, seed=seed, iterations=iterations,
+                    compress_constant_rows=compress_constant_rows, duplicates=duplicates
+                )
+            return packages
+
+        if not with_samples:
+            warnings.warn("No presamples created because there were no matrix data. "
+                          "Make sure to run `add_samples_for_all_acts` first.")
+            return
+        indices = MatrixIndices()
+        for database_name in with_samples:
+            indices.extend(self.balancers[database_name].matrix_indices)
+        samples = np.concatenate(
+            [self.balancers[database_name].matrix_samples for database_name in with_samples], axis=0
+        )
+        return PresamplesBackend().write(
+            indices, samples, name=name, id_=id_, overwrite=overwrite,
+            dirpath=dirpath, seed=seed, iterations=iterations,
+            compress_constant_rows=compress_constant_rows, duplicates=duplicates
+        )
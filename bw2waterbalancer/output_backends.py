@@ -0,0 +1,227 @@
+import numpy as np
+import shutil
+import uuid
+from pathlib import Path
+from bw2data import projects
+from presamples import create_presamples_package
+from .matrix_indices import MATRIX_TYPE_CODES
+
+try:
+    import bw_processing as bwp
+except ImportError:
+    bwp = None
+
+# Maximum number of rows or iterations of samples processed at once when writing
+WRITE_CHUNK_SIZE = 10000
+
+
+def get_output_backend(backend):
+    """Return output backend instance
+
+    Parameters:
+    -----------
+       backend: str or object
+           Name of a backend in `OUTPUT_BACKENDS`, or any object with a
+           `write(matrix_indices, samples, **kwargs)` method
+    """
+    if isinstance(backend, str):
+        if backend not in OUTPUT_BACKENDS:
+            raise ValueError("Unknown output backend {}, use one of {}".format(backend, sorted(OUTPUT_BACKENDS)))
+        return OUTPUT_BACKENDS[backend]()
+    if not callable(getattr(backend, 'write', None)):
+        raise ValueError("Output backends must have a `write` method")
+    return backend
+
+
+def _get_node_ids(keys):
+    """Return integer ids of activities and elementary flows used as matrix indices"""
+    try:
+        from bw2data import mapping
+    except ImportError:
+        # Newer versions of bw2data index matrices with node ids
+        from bw2data import get_node
+        return [get_node(database=key[0], code=key[1]).id for key in keys]
+    return [mapping[key] for key in keys]
+
+
+class PresamplesBackend():
+    """Write samples as presamples packages, see `DatabaseWaterBalancer.create_presamples`
+
+    Rows of `matrix_indices` and writable `samples` are first sorted in
+    place by matrix cell (see `MatrixIndices.sort`), so that the samples of
+    each package resource are written from a view of `samples` rather than
+    from a copy, with sorted and unique indices. Read-only samples are
+    sorted in a copy, with a copy of their indices. Samples of rows of the same
+    cell are merged in place for writing, then restored.
+    """
+    def write(self, matrix_indices, samples, name=None, id_=None, overwrite=False,
+              dirpath=None, seed='sequential', iterations=None, compress_constant_rows=False,
+              duplicates='merge'):
+        """Write presamples packages of all samples or of nested prefixes of samples"""
+        if duplicates not in ('merge', 'raise'):
+            raise ValueError("Unknown duplicates handling {}, use 'merge' or 'raise'".format(duplicates))
+        if samples.shape[0] != len(matrix_indices):
+            raise ValueError("Shape mismatch: {} samples, {} indices".format(samples.shape[0], len(matrix_indices)))
+        if not samples.flags.writeable:
+            # Sort copies, the caller's indices must keep matching its samples
+            samples = np.array(samples)
+            matrix_indices = matrix_indices.select(slice(None))
+        constant, n_constant = None, 0
+        if compress_constant_rows:
+            cell_ids = matrix_indices.get_cell_ids()
+            varying = np.zeros(len(matrix_indices), dtype=bool)
+            for start in range(0, len(matrix_indices), WRITE_CHUNK_SIZE):
+                rows = samples[start:start + WRITE_CHUNK_SIZE]
+                varying[start:start + WRITE_CHUNK_SIZE] = (rows != rows[:, :1]).any(axis=1)
+            # A cell is constant if none of its rows varies
+            constant = np.bincount(cell_ids, weights=varying)[cell_ids] == 0
+            n_constant = len(np.unique(cell_ids[constant]))
+        n_cells = matrix_indices.sort(
+            samples, np.array(_get_node_ids(matrix_indices.keys)), None if constant is None else ~constant
+        )
+        if n_cells < len(matrix_indices) and duplicates == 'raise':
+            raise ValueError("Several samples for matrix cell of index {}".format(matrix_indices[n_cells]))
+        cells, modified, original = matrix_indices.merge_duplicates(samples, n_cells)
+        try:
+            if not compress_constant_rows:
+                return self._write_cells(cells, samples[:n_cells], name, id_, overwrite, dirpath, seed, iterations)
+            # Constant cells come first
+            static = None
+            if n_constant:
+                static = create_presamples_package(
+                    matrix_data=cells.select(slice(0, n_constant)).split_samples(
+                        np.asarray(samples[:n_constant, :1])
+                    ),
+                    name=None if name is None else "{} - static".format(name),
+                    id_=None if id_ is None else "{}_static".format(id_),
+                    overwrite=overwrite, dirpath=dirpath, seed=seed)
+                print("Static presamples with id_ {} written at {}".format(*static))
+            packages = None
+            if n_constant < n_cells:
+                packages = self._write_cells(
+                    cells.select(slice(n_constant, n_cells)), samples[n_constant:n_cells],
+                    name, id_, overwrite, dirpath, seed, iterations
+                )
+            return packages, static
+        finally:
+            samples[modified] = original
+
+    @staticmethod
+    def _write_cells(cells, samples, name, id_, overwrite, dirpath, seed, iterations):
+        """Write packages of samples of sorted and unique matrix cells"""
+        if iterations is None:
+            id_, dirpath = create_presamples_package(
+                matrix_data=cells.split_samples(samples),
+                name=name, id_=id_, overwrite=overwrite, dirpath=dirpath, seed=seed)
+            print("Presamples with id_ {} written at {}".format(id_, dirpath))
+            return id_, dirpath
+
+        iterations = sorted(set(iterations))
+        if iterations[0] < 1 or iterations[-1] > samples.shape[1]:
+            raise ValueError("Numbers of iterations must be between 1 and the {} "
+                             "generated iterations".format(samples.shape[1]))
+        packages = {}
+        for count in iterations:
+            packages[count] = create_presamples_package(
+                matrix_data=cells.split_samples(samples[:, :count]),
+                name=None if name is None else "{} - {} iterations".format(name, count),
+                id_=None if id_ is None else "{}_{}".format(id_, count),
+                overwrite=overwrite, dirpath=dirpath, seed=seed)
+            print("Presamples with id_ {} written at {}".format(*packages[count]))
+        return packages
+
+
+class DatapackageBackend():
+    """Write samples as a bw_processing datapackage, as used by bw2calc 2
+
+    Samples are collapsed by matrix cell (see `MatrixIndices.collapse`) and
+    written as persistent arrays of the technosphere and biosphere matrices,
+    with technosphere inputs flagged to be flipped. Requires bw_processing.
+    """
+    def write(self, matrix_indices, samples, name=None, id_=None, overwrite=False,
+              dirpath=None, seed='sequential', archive=True):
+        """Write a datapackage of samples
+
+        Parameters:
+        -----------
+           matrix_indices: MatrixIndices
+               (input key, output key, matrix type) index of each row of samples
+           samples: numpy.ndarray
+               Samples (rows x iterations)
+           name: str, optional
+               A human-readable name for these samples
+           id_: str, optional
+               Unique id of the datapackage, generated automatically if not set
+           overwrite: bool, default=False
+               If True, replace an existing datapackage with the same ``id_``
+           dirpath: str, optional
+               Directory in which the datapackage is written. If None, a
+               subdirectory in the ``project`` folder.
+           seed: {None, int, "sequential"}, default="sequential"
+               Seed used to return array columns in random order, or
+               "sequential" to use them in order
+           archive: bool, default=True
+               If True, write a zip file, otherwise a directory
+
+        Returns:
+        --------
+           (id_, path) of the written datapackage
+        """
+        if bwp is None:
+            raise ImportError("bw_processing is needed to write datapackages")
+        id_ = id_ or uuid.uuid4().hex
+        name = name or id_
+        dirpath = Path(dirpath) if dirpath is not None else Path(projects.request_directory("datapackages"))
+        path = dirpath / ("{}.zip".format(id_) if archive else id_)
+        if path.exists():
+            if not overwrite:
+                raise ValueError("Datapackage {} already exists".format(path))
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+        if archive:
+            fs = bwp.generic_zipfile_filesystem(dirpath=dirpath, filename=path.name)
+        else:
+            fs = bwp.generic_directory_filesystem(dirpath=path)
+        datapackage = bwp.create_datapackage(
+            fs=fs, name=bwp.clean_datapackage_name(str(name)), id_=id_,
+            sequential=seed == 'sequential', seed=None if seed == 'sequential' else seed,
+        )
+
+        cells, cell_matrix = matrix_indices.collapse()
+        node_ids = np.array(_get_node_ids(cells.keys), dtype=np.int64)
+        array = cells.array
+        biosphere = array['type'] == MATRIX_TYPE_CODES['biosphere']
+        for matrix, mask in [('technosphere_matrix', ~biosphere), ('biosphere_matrix', biosphere)]:
+            if not mask.any():
+                continue
+            indices_array = np.empty(int(mask.sum()), dtype=bwp.INDICES_DTYPE)
+            indices_array['row'] = node_ids[array['input'][mask]]
+            indices_array['col'] = node_ids[array['output'][mask]]
+            datapackage.add_persistent_array(
+                matrix=matrix,
+                name="{}-{}".format(bwp.clean_datapackage_name(str(name)), matrix.replace('_', '-')),
+                indices_array=indices_array,
+                data_array=self._collapse_samples(cell_matrix[np.flatnonzero(mask)], samples),
+                flip_array=array['type'][mask] == MATRIX_TYPE_CODES['technosphere'],
+            )
+        datapackage.finalize_serialization()
+        print("Datapackage with id_ {} written at {}".format(id_, path))
+        return id_, path
+
+    @staticmethod
+    def _collapse_samples(cell_matrix, samples):
+        """Return samples summed by matrix cell, in chunks of iterations"""
+        collapsed = np.empty((cell_matrix.shape[0], samples.shape[1]), dtype=samples.dtype)
+        for start in range(0, samples.shape[1], WRITE_CHUNK_SIZE):
+            chunk = np.asarray(samples[:, start:start + WRITE_CHUNK_SIZE], dtype=np.float64)
+            collapsed[:, start:start + WRITE_CHUNK_SIZE] = cell_matrix @ chunk
+        return collapsed
+
+
+# Output backends available by name
+OUTPUT_BACKENDS = {
+    'presamples': PresamplesBackend,
+    'datapackage': DatapackageBackend,
+}
@@ -0,0 +1,175 @@
+import numpy as np
+import warnings
+import zlib
+from scipy.stats import qmc
+from stats_arrays import MCRandomNumberGenerator, uncertainty_choices
+
+SAMPLING_METHODS = ['random', 'lhs', 'sobol', 'antithetic']
+
+# Uncertainty type ids without inverse cumulative distribution function
+_NO_PPF_TYPES = set()
+
+
+def get_random_number_generator(params, sampling='random', seed=None):
+    """Return generator of samples of uncertain parameters
+
+    Parameters:
+    -----------
+       params: numpy.ndarray
+           stats_arrays parameter array
+       sampling: {'random', 'lhs', 'sobol', 'antithetic'}, default='random'
+           Pseudo-random sampling, Latin hypercube sampling, scrambled
+           Sobol sequence or antithetic pairs, see `QuasiRandomNumberGenerator`
+       seed: int, optional
+           Seed of the random number generator
+    """
+    if sampling == 'random':
+        return MCRandomNumberGenerator(params, seed=seed)
+    if sampling in ['lhs', 'sobol', 'antithetic']:
+        return QuasiRandomNumberGenerator(params, sampling, seed)
+    raise ValueError("Unknown sampling {}, use one of {}".format(sampling, SAMPLING_METHODS))
+
+
+def get_stream_seed(seed, *keys):
+    """Return seed of the random stream identified by `keys`
+
+    Streams of different keys, e.g. an activity key and the first iteration
+    of a block of samples, are derived from the same `seed` but are
+    independent. Returns None if `seed` is None.
+
+    Parameters:
+    -----------
+       seed: int
+           Seed of all streams
+       keys: hashable
+           Keys with a stable `repr`, identifying the stream
+    """
+    if seed is None:
+        return None
+    spawn_key = tuple(zlib.crc32(repr(key).encode()) for key in keys)
+    return int(np.random.SeedSequence(seed, spawn_key=spawn_key).generate_state(1)[0])
+
+
+def _has_ppf(params, type_id):
+    """Return True if stats_arrays implements the ppf of uncertainty type `type_id`"""
+    if type_id in _NO_PPF_TYPES:
+        return False
+    try:
+        uncertainty_choices[type_id].ppf(params[:1].copy(), np.array([[0.5]]))
+    except NotImplementedError:
+        _NO_PPF_TYPES.add(type_id)
+        return False
+    return True
+
+
+class QuasiRandomNumberGenerator():
+    """Generate samples with stratified, low-discrepancy or antithetic sequences
+
+    Points of the unit hypercube, with one dimension per parameter, are drawn
+    from a Latin hypercube ('lhs'), a scrambled Sobol sequence ('sobol') or
+    in antithetic pairs ('antithetic'), and transformed with the inverse cumulative distribution function (ppf)
+    of each parameter, restricted to its minimum and maximum if any.
+    Parameters whose distribution has no ppf in stats_arrays are sampled with
+    pseudo-random numbers instead.
+
+    Same `generate` interface as `stats_arrays.MCRandomNumberGenerator`.
+    Successive calls continue the Sobol sequence, while Latin hypercube
+    stratification holds within each call.
+
+    With antithetic sampling, each pseudo-random point `u` is followed by its
+    mirror `1 - u`, so that samples of even positions 2k and 2k+1 are
+    negatively correlated. Pairs are kept across successive calls: after an
+    odd number of samples, the next call starts with the pending mirror.
+
+    Parameters:
+    -----------
+    params: numpy.ndarray
+        stats_arrays parameter array
+    method: {'lhs', 'sobol', 'antithetic'}, default='lhs'
+        Sampling method
+    seed: int, optional
+        Seed of the random number generators
+    """
+    def __init__(self, params, method='lhs', seed=None):
+        self.params = params
+        self.method = method
+        self.length = len(params)
+        type_ids = params['uncertainty_type']
+        with_ppf = {type_id: _has_ppf(params[type_ids == type_id], type_id) for type_id in np.unique(type_ids)}
+        self.ppf_rows = np.flatnonzero([with_ppf[type_id] for type_id in type_ids])
+        self.random_rows = np.flatnonzero([not with_ppf[type_id] for type_id in type_ids])
+        if len(self.random_rows):
+            warnings.warn("No inverse cumulative distribution function for uncertainty "
+                          "types {}, sampled with pseudo-random numbers".format(
+                sorted(set(type_ids[self.random_rows].tolist()))
+            ))
+            self.random_generator = MCRandomNumberGenerator(params[self.random_rows], seed=seed)
+        if len(self.ppf_rows):
+            if method == 'antithetic':
+                self.engine = np.random.RandomState(seed)
+                self._mirrored = None
+            else:
+                engine = qmc.LatinHypercube if method == 'lhs' else qmc.Sobol
+                self.engine = engine(len(self.ppf_rows), seed=seed)
+            self.lower, self.upper = self._get_bounds(params[self.ppf_rows])
+
+    @staticmethod
+    def _get_bounds(params):
+        """Return cumulative probabilities of the minimum and maximum of each parameter"""
+        lower = np.zeros(len(params))
+        upper = np.ones(len(params))
+        for type_id in np.unique(params['uncertainty_type']):
+            rows = np.flatnonzero(params['uncertainty_type'] == type_id)
+            if type_id in [0, 1]:
+                continue
+            kls = uncertainty_choices[type_id]
+            type_params = params[rows]
+            # Negative distributions are mirrored, so their bounds are swapped
+            negative = type_params['negative'].astype(bool)
+            at_minimum = np.where(negative, 1., 0.)
+            at_maximum = np.where(negative, 0., 1.)
+            for bound, values in [('minimum', at_minimum), ('maximum', at_maximum)]:
+                bounded = np.isfinite(type_params[bound])
+                if bounded.any():
+                    values[bounded] = kls.cdf(
+                        type_params[bounded], type_params[bound][bounded].reshape(-1, 1).copy()
+                    ).ravel()
+            lower[rows] = np.minimum(at_minimum, at_maximum)
+            upper[rows] = np.maximum(at_minimum, at_maximum)
+        return lower, upper
+
+    def _get_antithetic_points(self, samples):
+        """Return array (parameters x samples) of points in antithetic pairs"""
+        points = np.empty((len(self.ppf_rows), samples), dtype=np.float64)
+        start = 0
+        if self._mirrored is not None and samples:
+            points[:, 0] = self._mirrored
+            self._mirrored = None
+            start = 1
+        n_pairs = (samples - start + 1) // 2
+        # Drawn pair by pair, so that chunked calls consume the same stream
+        uniform = self.engine.random_sample((n_pairs, len(self.ppf_rows))).T
+        pairs = np.empty((len(self.ppf_rows), 2 * n_pairs), dtype=np.float64)
+        pairs[:, 0::2] = uniform
+        pairs[:, 1::2] = 1 - uniform
+        points[:, start:] = pairs[:, :samples - start]
+        if 2 * n_pairs > samples - start:
+            self._mirrored = pairs[:, -1]
+        return points
+
+    def generate(self, samples=1):
+        """Return array (parameters x samples) of samples"""
+        result = np.empty((self.length, samples), dtype=np.float64)
+        if len(self.random_rows):
+            result[self.random_rows] = self.random_generator.generate(samples)
+        if len(self.ppf_rows):
+            if self.method == 'antithetic':
+                points = self._get_antithetic_points(samples)
+            else:
+                points = self.engine.random(samples).T
+            points = self.lower.reshape(-1, 1) + points * (self.upper - self.lower).reshape(-1, 1)
+            params = self.params[self.ppf_rows]
+            for type_id in np.unique(params['uncertainty_type']):
+                rows = np.flatnonzero(params['uncertainty_type'] == type_id)
+                result[self.ppf_rows[rows]] = uncertainty_choices[type_id].ppf(params[rows], points[rows])
+        return result
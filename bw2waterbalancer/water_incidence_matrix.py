@@ -0,0 +1,289 @@
+import json
+import numpy as np
+from scipy import sparse
+from stats_arrays import UncertaintyBase
+from .sampling import get_random_number_generator
+from .matrix_indices import MatrixIndices
+
+class WaterIncidenceMatrix():
+    """Sparse representation of the water balances of many activities
+
+    Each balanced water exchange of each activity that is not skipped is a
+    column of three sparse (activities x exchanges) matrices holding signed
+    coefficients converting exchange amounts to kg of water:
+        * variable: uncertain exchanges that are rescaled (inputs for the
+          default strategy, outputs for the inverse strategy)
+        * constant: other exchanges on the rescaled side of the balance
+        * reference: exchanges on the other side of the balance
+    For an array of exchange samples `X` (exchanges x iterations), the
+    scaling factors of all activities and iterations are then
+        (static_ratios * (reference @ X) - constant @ X) / (variable @ X)
+    Exchanges of activities with the set_static strategy are in none of these
+    matrices: they are simply set to their static amount.
+
+    Usually created by `DatabaseWaterBalancer.build_incidence_matrix`.
+
+    Parameters:
+    -----------
+    balancers: iterable
+        ActivityWaterBalancer instances with identified strategies.
+        Activities with the skip strategy are ignored.
+
+    Attributes:
+    -----------
+    act_keys: list
+        Keys of balanced activities, i.e. the rows of the sparse matrices
+    strategies: list
+        Strategy of each balanced activity
+    indices: MatrixIndices
+        (input key, output key, type) matrix index of each balanced exchange
+    row_acts: numpy.ndarray
+        Position in `act_keys` of the activity of each balanced exchange
+    roles: numpy.ndarray
+        Role of each balanced exchange ('variable', 'constant', 'reference'
+        or 'static')
+    amounts: numpy.ndarray
+        Static amount of each balanced exchange
+    params: numpy.ndarray
+        stats_arrays parameter array of each balanced exchange. Exchanges with
+        a static role have no uncertainty.
+    coefficients: numpy.ndarray
+        Signed coefficient converting each balanced exchange to kg
+    variable, constant, reference: scipy.sparse.csr_matrix
+        Signed coefficients to kg, by role
+    static_ratios: numpy.ndarray
+        Ratio of variable and constant terms to reference terms in the static
+        activity. nan for set_static activities.
+    """
+    def __init__(self, balancers):
+        self.act_keys = []
+        self.strategies = []
+        self.indices = MatrixIndices()
+        row_acts, roles, coefficients, param_dicts = [], [], [], []
+        for ab in balancers:
+            if ab.strategy == 'skip':
+                continue
+            try:
+                exchanges, act_roles, act_coefficients = ab._get_balancing_terms()
+            except Exception as err:
+                print(ab.act_key, str(err))
+                continue
+            for exc, role in zip(exchanges, act_roles):
+                param = ab._convert_exchange_to_param(exc, None)
+                if role == 'static':
+                    param['uncertainty type'] = 0
+                    param['loc'] = param['amount']
+                param_dicts.append(param)
+                self.indices.append(ab._get_matrix_index(exc))
+            row_acts.extend([len(self.act_keys)] * len(exchanges))
+            roles.extend(act_roles)
+            coefficients.extend(act_coefficients)
+            self.act_keys.append(ab.act_key)
+            self.strategies.append(ab.strategy)
+
+        self._set_exchanges(
+            row_acts, roles, UncertaintyBase.from_dicts(*param_dicts),
+            [param['amount'] for param in param_dicts], coefficients
+        )
+
+    def _set_exchanges(self, row_acts, roles, params, amounts, coefficients):
+        """Set arrays of balanced exchanges, and the role matrices and static ratios derived from them"""
+        self.row_acts = np.array(row_acts, dtype=np.int64)
+        self.roles = np.array(roles, dtype='<U9')
+        self.params = params
+        self.amounts = np.array(amounts, dtype=np.float64)
+        self.coefficients = np.array(coefficients, dtype=np.float64)
+        for role in ['variable', 'constant', 'reference']:
+            setattr(self, role, self._get_role_matrix(role, self.coefficients))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.static_ratios = (
+                (self.variable @ self.amounts + self.constant @ self.amounts)
+                / (self.reference @ self.amounts)
+            )
+        self.static_ratios[np.array(self.strategies) == 'set_static'] = np.nan
+
+    def __len__(self):
+        return len(self.indices)
+
+    def save(self, filepath, **metadata):
+        """Save the incidence matrix in a compressed numpy file
+
+        The file holds the arrays of balanced exchanges and can be loaded
+        with `load` without the project databases. Keyword arguments are
+        saved as JSON metadata.
+        """
+        np.savez_compressed(
+            filepath,
+            metadata=np.array(json.dumps(metadata)),
+            act_keys=np.array(json.dumps([list(act_key) for act_key in self.act_keys])),
+            keys=np.array(json.dumps([list(key) for key in self.indices.keys])),
+            strategies=np.array(self.strategies, dtype='<U10'),
+            indices=self.indices.array,
+            row_acts=self.row_acts,
+            roles=self.roles,
+            params=self.params,
+            amounts=self.amounts,
+            coefficients=self.coefficients,
+        )
+
+    @classmethod
+    def load(cls, filepath):
+        """Load an incidence matrix saved with `save`
+
+        Returns:
+        --------
+           (WaterIncidenceMatrix, metadata) tuple
+        """
+        with np.load(filepath, allow_pickle=False) as data:
+            incidence_matrix = cls.__new__(cls)
+            incidence_matrix.act_keys = [tuple(act_key) for act_key in json.loads(str(data['act_keys']))]
+            incidence_matrix.strategies = data['strategies'].tolist()
+            incidence_matrix.indices = MatrixIndices.from_array(
+                [tuple(key) for key in json.loads(str(data['keys']))], data['indices']
+            )
+            incidence_matrix._set_exchanges(
+                data['row_acts'], data['roles'], data['params'], data['amounts'], data['coefficients']
+            )
+            return incidence_matrix, json.loads(str(data['metadata']))
+
+    def _get_role_matrix(self, role, coefficients):
+        """Return sparse (activities x exchanges) matrix of coefficients for role"""
+        mask = self.roles == role
+        cols = np.flatnonzero(mask)
+        return sparse.csr_matrix(
+            (coefficients[mask], (self.row_acts[mask], cols)),
+            shape=(len(self.act_keys), len(self.indices))
+        )
+
+    def sample(self, iterations, seed=None, sampling='random'):
+        """Return independent, unbalanced samples of all balanced exchanges
+
+        See `get_random_number_generator` for `sampling` methods.
+        """
+        return self._sample(get_random_number_generator(self.params, sampling, seed), iterations)
+
+    def _sample(self, rng, iterations):
+        """Return unbalanced samples drawn from a stats_arrays random number generator"""
+        return rng.generate(iterations).reshape(len(self), iterations)
+
+    def balance(self, samples):
+        """Rescale variable exchange samples in place, and return them
+
+        Parameters:
+        -----------
+           samples: numpy.ndarray
+               Array (exchanges x iterations) of float64 exchange samples
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scaling = (
+                self.static_ratios.reshape(-1, 1) * (self.reference @ samples)
+                - self.constant @ samples
+            ) / (self.variable @ samples)
+        variable = self.roles == 'variable'
+        samples[variable] *= scaling[self.row_acts[variable]]
+        return samples
+
+    def get_ratios(self, samples):
+        """Return ratio of variable and constant terms to reference terms
+
+        Returns an (activities x iterations) array, equal to `static_ratios`
+        for all iterations if `samples` are balanced.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (self.variable @ samples + self.constant @ samples) / (self.reference @ samples)
+
+    def generate_samples(self, iterations, seed=None, chunk_size=None, sampling='random'):
+        """Yield balanced samples in chunks of at most `chunk_size` iterations
+
+        All chunks are drawn from the same random number generator. See
+        `get_random_number_generator` for `sampling` methods.
+        """
+        rng = get_random_number_generator(self.params, sampling, seed)
+        chunk_size = chunk_size or iterations
+        for start in range(0, iterations, chunk_size):
+            yield self.balance(self._sample(rng, min(chunk_size, iterations - start)))
+
+    def get_deviations(self, samples, indices, chunk_size=1000):
+        """Return maximum relative deviation of samples from the balance of each activity
+
+        For activities with the default or inverse strategy, the deviation
+        is that of the ratio of variable and constant terms to reference
+        terms from `static_ratios`. For activities with the set_static
+        strategy, it is that of the static exchange from its amount.
+        Balanced exchanges without samples are taken at their static amount.
+        Rows of `samples` with the same index are summed.
+
+        Activities whose balance cannot be reconstructed from `samples` have
+        a nan deviation: this is the case when exchanges with the same index
+        have different roles or coefficients, when an exchange only has
+        samples under an index of another type, e.g. production and
+        technosphere samples collapsed in a presamples package, or when the
+        static balance itself has no ratio. Activities with nan or infinite
+        samples have an infinite deviation.
+
+        Parameters:
+        -----------
+           samples: numpy.ndarray
+               Array (rows x iterations) of samples
+           indices: iterable
+               (input key, output key, matrix type) index of each row
+           chunk_size: int, default=1000
+               Maximum number of iterations verified at once
+
+        Returns:
+        --------
+           numpy.ndarray with the deviation of each activity in `act_keys`
+        """
+        columns = {}
+        for column, index in enumerate(self.indices):
+            columns.setdefault(index, []).append(column)
+        matched = np.zeros(len(self), dtype=bool)
+        unverifiable = np.zeros(len(self.act_keys), dtype=bool)
+        sampled_pairs = set()
+        sample_rows, sample_columns = [], []
+        for row, index in enumerate(indices):
+            sampled_pairs.add(tuple(index[:2]))
+            index_columns = columns.get(tuple(index))
+            if index_columns is None:
+                continue
+            if len(index_columns) > 1 and (
+                    len(set(self.roles[index_columns])) > 1
+                    or len(set(self.coefficients[index_columns])) > 1):
+                unverifiable[self.row_acts[index_columns]] = True
+            sample_rows.append(row)
+            sample_columns.append(index_columns[0])
+            matched[index_columns] = True
+        for column in np.flatnonzero(~matched):
+            if tuple(self.indices[column][:2]) in sampled_pairs:
+                unverifiable[self.row_acts[column]] = True
+        # Sums sample rows mapped to the same balanced exchange
+        to_exchanges = sparse.csr_matrix(
+            (np.ones(len(sample_rows)), (sample_columns, sample_rows)),
+            shape=(len(self), samples.shape[0])
+        )
+
+        balanced = np.array(self.strategies) != 'set_static'
+        static = self.roles == 'static'
+        deviations = np.zeros(len(self.act_keys), dtype=np.float64)
+        iterations = samples.shape[1]
+        for start in range(0, iterations, chunk_size):
+            chunk = np.asarray(samples[:, start:start + chunk_size], dtype=np.float64)
+            exchanges = to_exchanges @ chunk
+            exchanges[~matched] = self.amounts[~matched].reshape(-1, 1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratios = self.get_ratios(exchanges)[balanced]
+                static_ratios = self.static_ratios[balanced].reshape(-1, 1)
+                ratio_deviations = np.where(
+                    ratios == static_ratios, 0, np.abs(ratios / static_ratios - 1)
+                ).max(axis=1)
+                static_deviations = np.where(
+                    exchanges[static] == self.amounts[static].reshape(-1, 1), 0,
+                    np.abs(exchanges[static] / self.amounts[static].reshape(-1, 1) - 1)
+                ).max(axis=1)
+            deviations[balanced] = np.maximum(deviations[balanced], ratio_deviations)
+            deviations[self.row_acts[static]] = np.maximum(deviations[self.row_acts[static]], static_deviations)
+        unverifiable[balanced] |= np.isnan(self.static_ratios[balanced])
+        # Other nan deviations come from invalid samples
+        deviations[np.isnan(deviations)] = np.inf
+        deviations[unverifiable] = np.nan
+        return deviations
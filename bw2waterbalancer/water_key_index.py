@@ -0,0 +1,136 @@
+import numpy as np
+import warnings
+
+# Factors converting water exchange amounts to kg, by (lower case) unit name
+DEFAULT_UNIT_CONVERSIONS = {
+    'kilogram': 1,
+    'kg': 1,
+    'gram': 0.001,
+    'ton': 1000,
+    'metric ton': 1000,
+    'tonne': 1000,
+    'cubic meter': 1000,
+    'cubic metre': 1000,
+    'm3': 1000,
+    'litre': 1,
+    'liter': 1,
+    'l': 1,
+    'cubic decimeter': 1,
+    'cubic decimetre': 1,
+    'kilolitre': 1000,
+    'kiloliter': 1000,
+    'megalitre': 1e6,
+    'megaliter': 1e6,
+}
+
+class WaterKeyIndex():
+    """Index of water keys used to classify water exchanges
+
+    Holds the keys of activities and elementary flows considered in water
+    balances, grouped by category, and the factors used to convert water
+    exchange amounts to kg. It does not depend on the project database, so it
+    can be used to classify exchange data read in bulk or be sent to worker
+    processes. Usually created by a DatabaseWaterBalancer instance.
+
+    Parameters:
+    -----------
+    techno_transfo_keys: list
+        Keys of activities with positive water reference exchanges
+    techno_treat_keys: list
+        Keys of activities with negative water reference exchanges
+    bio_ress_keys: list
+        Keys of water elementary flows from nature
+    bio_emission_keys: list
+        Keys of water elementary flows to nature
+    unit_conversions: dict, optional
+        Factors converting water exchange amounts to kg, by unit name. Added
+        to, and take precedence over, `DEFAULT_UNIT_CONVERSIONS`. Exchanges
+        in other units are not considered in balances.
+
+    Attributes:
+    -----------
+    categories: dict
+        Category ('techno_transfo', 'techno_treat', 'bio_ress' or
+        'bio_emission') of each water key
+    unit_conversions: dict
+        Factors converting water exchange amounts to kg, by lower case unit name
+    """
+    def __init__(self, techno_transfo_keys, techno_treat_keys, bio_ress_keys,
+                 bio_emission_keys, unit_conversions=None):
+        self.techno_transfo_keys = techno_transfo_keys
+        self.techno_treat_keys = techno_treat_keys
+        self.bio_ress_keys = bio_ress_keys
+        self.bio_emission_keys = bio_emission_keys
+        self.all_water_keys = \
+            self.techno_transfo_keys + self.techno_treat_keys + \
+            self.bio_ress_keys + self.bio_emission_keys
+        self.categories = {}
+        for category in ['techno_transfo', 'techno_treat', 'bio_ress', 'bio_emission']:
+            for key in getattr(self, "{}_keys".format(category)):
+                self.categories[key] = category
+        self.unit_conversions = {}
+        self._unknown_units = set()
+        for unit, factor in dict(DEFAULT_UNIT_CONVERSIONS, **(unit_conversions or {})).items():
+            self.register_unit(unit, factor)
+
+    def __contains__(self, key):
+        return key in self.categories
+
+    def register_unit(self, unit, factor):
+        """Register factor converting amounts in `unit` to kg
+
+        Parameters:
+        -----------
+           unit: str
+               Unit name, as found in exchange data. Not case sensitive.
+           factor: float
+               Mass of water, in kg, of one `unit`
+        """
+        if not factor > 0:
+            raise ValueError("Conversion factor for unit {} must be positive, got {}".format(unit, factor))
+        self.unit_conversions[unit.lower()] = factor
+        self._unknown_units.discard(unit.lower())
+
+    def get_exchange_type(self, exc):
+        """Return type of water exchange"""
+        category = self.categories.get(exc['input'])
+        if category in ['techno_transfo', 'techno_treat']:
+            if exc.get('type') == 'production':
+                return '{}_output'.format(category)
+            if exc.get('type') == 'technosphere':
+                return '{}_input'.format(category)
+        elif category is not None:
+            return category
+        # If not returned anything yet, it was impossible to classify
+        warnings.warn(
+            "Exchange type not understood for exchange "
+            "between {} and {} ({}), not considered in balance.".format(
+                exc['input'], exc.get('output'), exc.get('type')
+            ))
+        return 'skip'
+
+    def get_conversion_factor_to_kg(self, exc):
+        """Return a conversion factor to kg, None if unit not recognized"""
+        return self._get_unit_conversion_factor(exc.get('unit'))
+
+    def get_conversion_factors_to_kg(self, exchanges):
+        """Return array of conversion factors to kg, nan if unit not recognized
+
+        Factors are resolved once per unit.
+        """
+        units = [exc.get('unit') for exc in exchanges]
+        factors = {unit: self._get_unit_conversion_factor(unit) for unit in set(units)}
+        return np.array(
+            [np.nan if factors[unit] is None else factors[unit] for unit in units],
+            dtype=np.float64
+        )
+
+    def _get_unit_conversion_factor(self, unit):
+        """Return factor converting `unit` to kg, warn once if unit not recognized"""
+        unit = (unit or '').lower()
+        factor = self.unit_conversions.get(unit)
+        if factor is None and unit not in self._unknown_units:
+            self._unknown_units.add(unit)
+            warnings.warn("Unit {} not recognized, water exchanges in this unit "
+                          "are skipped. Use `register_unit` to add it.".format(unit))
+        return factor
@@ -0,0 +1,149 @@
+import numpy as np
+from collections import OrderedDict
+from .sampling import SAMPLING_METHODS, get_stream_seed
+from .water_incidence_matrix import WaterIncidenceMatrix
+from .in_memory_presamples import InMemoryPresamplesLoader
+
+# Version of the format of files written by `WaterSampleRecipe.save`
+RECIPE_FORMAT_VERSION = 1
+# Default number of iterations drawn from the same random stream
+RECIPE_BLOCK_SIZE = 100
+# Default number of generated blocks kept in memory
+RECIPE_CACHE_SIZE = 8
+
+
+class WaterSampleRecipe():
+    """Procedural description of balanced water samples
+
+    Balanced samples are a deterministic function of the water incidence
+    matrix of a database (static amounts, uncertainty, roles and strategies
+    of balanced exchanges), the sampling method and a seed. A recipe only
+    stores these, and regenerates samples of requested iterations on demand
+    with the vectorized engine, instead of storing all samples.
+
+    Iterations are drawn in blocks of `block_size` iterations, each from its
+    own random stream: samples of iterations ``[start, start + block_size)``
+    are those of
+    ``DatabaseWaterBalancer.add_samples_for_all_acts(block_size, engine='vectorized', seed=seed, start=start)``.
+    Only the blocks holding requested iterations are generated, and the
+    `cache_size` last used blocks are kept in memory. Iterations requested
+    in random order thus regenerate a whole block for each iteration unless
+    all blocks fit in the cache.
+
+    Usually created by `DatabaseWaterBalancer.create_recipe`.
+
+    Parameters:
+    -----------
+    incidence_matrix: WaterIncidenceMatrix
+        Water incidence matrix of the database
+    iterations: int
+        Number of iterations
+    seed: int
+        Seed of the random streams
+    sampling: {'random', 'lhs', 'sobol', 'antithetic'}, default='random'
+        Method used to draw uncertain water exchanges
+    block_size: int, default=RECIPE_BLOCK_SIZE
+        Number of iterations drawn from the same random stream
+    dtype: numpy floating dtype, default=np.float64
+        Data type of returned samples
+    cache_size: int, default=RECIPE_CACHE_SIZE
+        Number of generated blocks kept in memory
+    """
+    def __init__(self, incidence_matrix, iterations, seed, sampling='random',
+                 block_size=RECIPE_BLOCK_SIZE, dtype=np.float64, cache_size=RECIPE_CACHE_SIZE):
+        if sampling not in SAMPLING_METHODS:
+            raise ValueError("Unknown sampling {}, use one of {}".format(sampling, SAMPLING_METHODS))
+        if seed is None:
+            raise ValueError("A seed is needed to regenerate samples")
+        self.incidence_matrix = incidence_matrix
+        self.iterations = int(iterations)
+        self.seed = int(seed)
+        self.sampling = sampling
+        self.block_size = int(block_size)
+        self.dtype = np.dtype(dtype)
+        self.cache_size = max(1, int(cache_size))
+        self._blocks = OrderedDict()
+
+    def __len__(self):
+        return len(self.incidence_matrix)
+
+    @property
+    def n_blocks(self):
+        """Number of blocks of iterations"""
+        return -(-self.iterations // self.block_size)
+
+    @property
+    def indices(self):
+        """(input key, output key, matrix type) index of each row of samples"""
+        return self.incidence_matrix.indices
+
+    def save(self, filepath):
+        """Save the recipe in a compressed numpy file, see `load`"""
+        self.incidence_matrix.save(
+            filepath,
+            format_version=RECIPE_FORMAT_VERSION,
+            iterations=self.iterations,
+            seed=self.seed,
+            sampling=self.sampling,
+            block_size=self.block_size,
+            dtype=self.dtype.str,
+        )
+
+    @classmethod
+    def load(cls, filepath, cache_size=RECIPE_CACHE_SIZE):
+        """Load a recipe saved with `save`, without the project databases"""
+        incidence_matrix, metadata = WaterIncidenceMatrix.load(filepath)
+        if metadata.get('format_version') != RECIPE_FORMAT_VERSION:
+            raise ValueError("Recipe format version {} not supported".format(metadata.get('format_version')))
+        return cls(
+            incidence_matrix, metadata['iterations'], metadata['seed'], metadata['sampling'],
+            metadata['block_size'], np.dtype(metadata['dtype']), cache_size
+        )
+
+    def generate(self, start=0, stop=None):
+        """Return array (rows x iterations) of samples of iterations `start` to `stop`
+
+        Parameters:
+        -----------
+           start: int, default=0
+               First iteration
+           stop: int, optional
+               Iteration after the last one. Defaults to `iterations`.
+        """
+        stop = self.iterations if stop is None else stop
+        if not 0 <= start < stop <= self.iterations:
+            raise ValueError("Iterations {} to {} not in the {} iterations of recipe".format(
+                start, stop, self.iterations
+            ))
+        chunks = []
+        for block_start in range(start - start % self.block_size, stop, self.block_size):
+            block = self._get_block(block_start)
+            chunks.append(block[:, max(start - block_start, 0):stop - block_start])
+        return chunks[0] if len(chunks) == 1 else np.concatenate(chunks, axis=1)
+
+    def get_matrix_data(self, start=0, stop=None):
+        """Return presamples matrix data of samples of iterations `start` to `stop`"""
+        return self.indices.split_samples(self.generate(start, stop))
+
+    def get_presamples_loader(self, seed='sequential', lca=None):
+        """Return a presamples data loader generating samples of iterations used by an LCA
+
+        See `InMemoryPresamplesLoader`. With a random column order, each
+        iteration may regenerate a block of iterations unless all blocks
+        fit in the cache (see `cache_size`).
+        """
+        return InMemoryPresamplesLoader(self.indices, self, seed=seed, lca=lca)
+
+    def _get_block(self, block_start):
+        """Return samples of the block of iterations starting at `block_start`"""
+        if block_start in self._blocks:
+            self._blocks.move_to_end(block_start)
+            return self._blocks[block_start]
+        iterations = min(self.block_size, self.iterations - block_start)
+        samples = next(self.incidence_matrix.generate_samples(
+            iterations, seed=get_stream_seed(self.seed, block_start), sampling=self.sampling
+        ))
+        self._blocks[block_start] = samples.astype(self.dtype, copy=False)
+        if len(self._blocks) > self.cache_size:
+            self._blocks.popitem(last=False)
+        return self._blocks[block_start]
@@ -23,7 +23,12 @@ setup(
         'numpy',
         'pyprind',
         'presamples',
+        'scipy',
+        'stats_arrays',
     ],
+    extras_require={
+        'datapackage': ['bw_processing'],
+    },
     url="https://gitlab.com/pascal.lesage/bw2waterbalance",
     long_description=readme,
     long_description_content_type="text/markdown",
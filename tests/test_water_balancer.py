@@ -1,8 +1,17 @@
 import pytest
+import threading
+import warnings
 import numpy as np
 from bw2waterbalancer.database_water_balancer import DatabaseWaterBalancer
 from bw2waterbalancer.activity_water_balancer import ActivityWaterBalancer
-from brightway2 import get_activity
+from bw2waterbalancer.matrix_indices import MatrixIndices
+from bw2waterbalancer.multi_database_water_balancer import MultiDatabaseWaterBalancer
+from bw2waterbalancer.water_sample_recipe import WaterSampleRecipe
+from bw2waterbalancer.sampling import QuasiRandomNumberGenerator, get_random_number_generator
+from brightway2 import get_activity, Database, databases, mapping
+from bw2data.backends.peewee import SQLiteBackend
+from bw2data.parameters import ActivityParameter
+from presamples import split_inventory_presamples
 
 def helper_get_matrix_data_sums_for_test(ab, matrix_data):
     """Helper function to return inputs and outputs in `matrix_data`
@@ -183,7 +192,7 @@ def test_reset(data_for_testing):
 
 def test_rebalance_default_ratio_1(data_for_testing):
     wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
-    assert wb.matrix_indices == []
+    assert len(wb.matrix_indices) == 0
     assert wb.matrix_samples is None
     ab = ActivityWaterBalancer(('test_db', 'A'), wb)
     ab._identify_strategy()
@@ -571,7 +580,7 @@ def test_rebalance_tap_water_market_losses(data_for_testing):
 
 def test_all_matrix_data_and_presamples(data_for_testing):
     wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
-    assert wb.matrix_indices==[]
+    assert len(wb.matrix_indices)==0
     assert wb.matrix_samples is None
     wb.add_samples_for_all_acts(5)
     assert len(wb.matrix_indices)==98
@@ -585,3 +594,940 @@ def test_all_matrix_data_and_presamples(data_for_testing):
     assert samples_0.shape[1] == 5
     assert samples_1.shape[1] == 5
     assert samples_0.shape[0] + samples_1.shape[0] == 97
+    # Rows were reordered in place, biosphere rows first, but not merged
+    types = wb.matrix_indices.array['type']
+    assert (types[:samples_0.shape[0]] == 2).all() and (types[samples_0.shape[0]:] != 2).all()
+    assert wb.matrix_samples.shape == (98, 5)
+    verification = wb.verify_balance()
+    assert verification['unverified'] == []
+    assert verification['max_deviation'] < 1e-10
+    # Written cells are unique
+    ids = np.load(dirpath / "{}.1.indices.npy".format(id_))
+    cells = list(zip(ids['input'].tolist(), ids['output'].tolist()))
+    assert len(cells) == len(set(cells))
+
+
+def test_presamples_read_only_samples(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(5)
+    indices = list(wb.matrix_indices)
+    wb.matrix_samples.setflags(write=False)
+    id_, dirpath = wb.create_presamples(id_="read_only")
+    assert list(wb.matrix_indices) == indices
+    assert wb.verify_balance()['max_deviation'] < 1e-10
+    assert wb.verify_balance(dirpath)['max_deviation'] < 1e-10
+
+
+def test_nested_presamples(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(10, engine='vectorized')
+    packages = wb.create_presamples(id_="nested", iterations=[10, 2, 5])
+    assert sorted(packages) == [2, 5, 10]
+    largest = np.load(packages[10][1] / "nested_10.0.samples.npy")
+    for count in [2, 5]:
+        id_, dirpath = packages[count]
+        assert id_ == "nested_{}".format(count)
+        assert np.allclose(np.load(dirpath / "{}.0.samples.npy".format(id_)), largest[:, :count])
+        assert wb.verify_balance(dirpath)['max_deviation'] < 1e-10
+    with pytest.raises(ValueError):
+        wb.create_presamples(iterations=[5, 20])
+
+
+def test_compress_constant_rows(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(6, engine='vectorized')
+    constant = (wb.matrix_samples == wb.matrix_samples[:, :1]).all(axis=1)
+    assert constant.any() and not constant.all()
+    (id_, dirpath), (static_id, static_dirpath) = wb.create_presamples(
+        id_="compressed", compress_constant_rows=True
+    )
+    assert static_id == "compressed_static"
+    static_samples = [np.load(path) for path in static_dirpath.glob("*.samples.npy")]
+    assert all(samples.shape[1] == 1 for samples in static_samples)
+    samples = [np.load(path) for path in dirpath.glob("*.samples.npy")]
+    assert sum(s.shape[0] for s in samples) + sum(s.shape[0] for s in static_samples) == 97
+    verification = wb.verify_balance([dirpath, static_dirpath])
+    assert verification['max_deviation'] < 1e-10
+    assert verification['unverified'] == [('test_db', 'V')]
+    constant = (wb.matrix_samples == wb.matrix_samples[:, :1]).all(axis=1)
+    assert len(wb.matrix_indices.select(constant)) == constant.sum()
+    assert list(wb.matrix_indices.select(constant)) == [
+        index for index, is_constant in zip(wb.matrix_indices, constant) if is_constant
+    ]
+
+
+def test_output_backends(data_for_testing):
+    class RecordingBackend():
+        def write(self, matrix_indices, samples, **kwargs):
+            self.written = (len(matrix_indices), samples.shape, kwargs)
+            return "recorded"
+
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    with pytest.warns(UserWarning):
+        assert wb.write_samples() is None
+    wb.add_samples_for_all_acts(3, engine='vectorized')
+    backend = RecordingBackend()
+    assert wb.write_samples(backend, name="test") == "recorded"
+    assert backend.written == (98, (98, 3), {'name': "test"})
+    id_, dirpath = wb.write_samples('presamples', id_="backend")
+    assert wb.verify_balance(dirpath)['max_deviation'] < 1e-10
+    with pytest.raises(ValueError):
+        wb.write_samples('netcdf')
+
+
+def test_datapackage_backend(data_for_testing, tmp_path):
+    bwp = pytest.importorskip("bw_processing")
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(3, engine='vectorized')
+    id_, path = wb.write_samples('datapackage', id_="dp", dirpath=tmp_path)
+    datapackage = bwp.load_datapackage(bwp.generic_zipfile_filesystem(
+        dirpath=tmp_path, filename=path.name, write=False
+    ))
+    cells, cell_matrix = wb.matrix_indices.collapse()
+    n_rows = sum(
+        datapackage.get_resource(resource['name'])[0].shape[0]
+        for resource in datapackage.resources if resource['kind'] == 'data'
+    )
+    assert n_rows == len(cells)
+
+
+def test_datapackage_backend_calls(data_for_testing, tmp_path, monkeypatch):
+    from types import SimpleNamespace
+    from bw2waterbalancer import output_backends
+    calls = []
+
+    class StubDatapackage():
+        def add_persistent_array(self, **kwargs):
+            calls.append(('add_persistent_array', kwargs))
+
+        def finalize_serialization(self):
+            calls.append(('finalize_serialization', {}))
+
+    def create_datapackage(**kwargs):
+        calls.append(('create_datapackage', kwargs))
+        return StubDatapackage()
+
+    monkeypatch.setattr(output_backends, 'bwp', SimpleNamespace(
+        INDICES_DTYPE=np.dtype([('row', np.int32), ('col', np.int32)]),
+        generic_zipfile_filesystem=lambda dirpath, filename: ('zip', dirpath, filename),
+        generic_directory_filesystem=lambda dirpath: ('dir', dirpath),
+        clean_datapackage_name=lambda name: name.lower(),
+        create_datapackage=create_datapackage,
+    ))
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(3, engine='vectorized')
+    cells, cell_matrix = wb.matrix_indices.collapse()
+    expected = {
+        (mapping[input_key], mapping[output_key], matrix_type == 'biosphere'): row
+        for (input_key, output_key, matrix_type), row in zip(cells, cell_matrix @ wb.matrix_samples)
+    }
+    id_, path = wb.write_samples('datapackage', id_="dp", name="DP", dirpath=tmp_path, seed=4)
+    assert path == tmp_path / "dp.zip"
+    assert [name for name, _ in calls] == [
+        'create_datapackage', 'add_persistent_array', 'add_persistent_array', 'finalize_serialization'
+    ]
+    assert calls[0][1] == {'fs': ('zip', tmp_path, "dp.zip"), 'name': "dp", 'id_': "dp",
+                           'sequential': False, 'seed': 4}
+    n_rows = 0
+    for (_, kwargs), matrix in zip(calls[1:3], ['technosphere_matrix', 'biosphere_matrix']):
+        assert kwargs['matrix'] == matrix
+        indices, data, flip = kwargs['indices_array'], kwargs['data_array'], kwargs['flip_array']
+        assert len(indices) == len(data) == len(flip)
+        n_rows += len(indices)
+        for (row, col), samples, flipped in zip(indices.tolist(), data, flip):
+            assert np.allclose(samples, expected[(row, col, matrix == 'biosphere_matrix')])
+            # Technosphere inputs, but not production cells, are flipped
+            cell = [cell for cell in cells if (mapping[cell[0]], mapping[cell[1]]) == (row, col)
+                    and (cell[2] == 'biosphere') == (matrix == 'biosphere_matrix')][0]
+            assert flipped == (cell[2] == 'technosphere')
+    assert n_rows == len(cells)
+    wb.write_samples('datapackage', id_="dir", dirpath=tmp_path, archive=False)
+    assert calls[-4][1]['fs'] == ('dir', tmp_path / "dir")
+
+
+def test_float32_samples_and_presamples(data_for_testing):
+    wb = DatabaseWaterBalancer(
+        ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere", dtype=np.float32
+    )
+    wb.add_samples_for_all_acts(5)
+    assert wb.matrix_samples.dtype == np.float32
+    assert wb.matrix_samples.shape == (98, 5)
+    id_, dirpath = wb.create_presamples(id_="test_float32")
+    assert np.load(dirpath/"{}.0.samples.npy".format(id_)).dtype == np.float32
+    assert np.load(dirpath/"{}.1.samples.npy".format(id_)).dtype == np.float32
+
+
+def test_non_float_dtype(data_for_testing):
+    with pytest.raises(ValueError, match="dtype must be a floating point type"):
+        DatabaseWaterBalancer(
+            ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere", dtype=np.int32
+        )
+
+
+def test_plan(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    plan = wb.plan(5, calibration_size=0)
+    assert plan['estimated_seconds'] is None
+    assert plan['exchanges'] == 98
+    assert plan['matrix_samples_nbytes'] == 98 * 5 * 8
+    assert sum(plan['strategies'].values()) == len(plan['activities'])
+    # Planning does not modify exchanges
+    exc = [exc for exc in get_activity(("test_db", "A")).exchanges()
+           if exc.input.key == ('biosphere', 'Water 1, from nature, in kg')][0]
+    assert exc['formula'] == 'some_good_formula'
+    assert 'water_formula' not in exc
+    for act_key, act_plan in plan['activities'].items():
+        ab = ActivityWaterBalancer(act_key, wb)
+        ab._identify_strategy()
+        assert act_plan['strategy'] == ab.strategy
+
+
+def test_plan_with_calibration(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    modified = databases['test_db']['modified']
+    exchanges = {act.key: sorted([exc.as_dict() for exc in act.exchanges()], key=repr)
+                 for act in Database("test_db")}
+    n_parameters = len(ActivityParameter.select())
+    plans = {engine: wb.plan(5, dtype=np.float32, calibration_size=50, engine=engine)
+             for engine in ['parameters', 'pipelined']}
+    for plan in plans.values():
+        assert plan['matrix_samples_nbytes'] == 98 * 5 * 4
+        assert plan['estimated_seconds'] > 0
+    # The parameters engine is calibrated with its own, slower, runtime
+    assert plans['parameters']['estimated_seconds'] > plans['pipelined']['estimated_seconds']
+    assert wb.matrix_samples is None
+    # Calibration does not write to the database either
+    assert databases['test_db']['modified'] == modified
+    assert {act.key: sorted([exc.as_dict() for exc in act.exchanges()], key=repr)
+            for act in Database("test_db")} == exchanges
+    assert len(ActivityParameter.select()) == n_parameters
+    exc = [exc for exc in get_activity(("test_db", "A")).exchanges()
+           if exc.input.key == ('biosphere', 'Water 1, from nature, in kg')][0]
+    assert exc['formula'] == 'some_good_formula'
+    with pytest.raises(ValueError):
+        wb.plan(5, engine='unknown')
+
+
+def test_generate_samples_in_chunks(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    ab = ActivityWaterBalancer(('test_db', 'C'), wb)
+    matrix_data = ab.generate_samples(5, chunk_size=2)
+    assert matrix_data[0][0].shape == (5, 5)
+    assert matrix_data[1][0].shape == (4, 5)
+    in_sum, out_sum = helper_get_matrix_data_sums_for_test(ab, matrix_data)
+    assert np.allclose(in_sum/out_sum, ab.static_ratio)
+
+
+def test_memory_limit_in_memory(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(5, memory_limit=10**8)
+    assert not isinstance(wb.matrix_samples, np.memmap)
+    assert wb.samples_filepath is None
+    assert wb.matrix_samples.shape == (98, 5)
+    assert len(wb.matrix_indices) == 98
+
+
+def test_memory_limit_streamed_to_disk(data_for_testing, tmp_path):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(5, memory_limit=1000, spill_dirpath=tmp_path)
+    assert isinstance(wb.matrix_samples, np.memmap)
+    assert wb.samples_filepath.parent == tmp_path
+    assert wb.matrix_samples.shape == (98, 5)
+    assert np.allclose(np.load(wb.samples_filepath), wb.matrix_samples)
+    id_, dirpath = wb.create_presamples(id_="test_streamed")
+    samples_0 = np.load(dirpath/"{}.0.samples.npy".format(id_))
+    samples_1 = np.load(dirpath/"{}.1.samples.npy".format(id_))
+    assert samples_0.shape[0] + samples_1.shape[0] == 97
+
+
+def test_unit_registry(data_for_testing):
+    wb = DatabaseWaterBalancer(
+        ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere",
+        unit_conversions={'barrel': 159}
+    )
+    exchanges = [{'unit': 'litre'}, {'unit': 'Cubic meter'}, {'unit': 'barrel'}, {'unit': 'furlong'}]
+    with pytest.warns(UserWarning, match="Unit furlong not recognized") as record:
+        factors = wb.water_key_index.get_conversion_factors_to_kg(exchanges + exchanges)
+    assert len(record) == 1
+    assert np.allclose(factors[:3], [1, 1000, 159])
+    assert np.isnan(factors[3])
+    wb.register_unit('furlong', 2)
+    assert wb.water_key_index.get_conversion_factor_to_kg({'unit': 'furlong'}) == 2
+    with pytest.raises(ValueError, match="must be positive"):
+        wb.register_unit('nothing', 0)
+
+
+def test_registered_unit_used_in_balance(data_for_testing):
+    act = get_activity(('test_db', 'A'))
+    exc = [exc for exc in act.exchanges() if exc.input.key == ('biosphere', 'Water 1, from nature, in kg')][0]
+    exc['unit'] = 'litre'
+    exc.save()
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    ab = ActivityWaterBalancer(('test_db', 'A'), wb)
+    ab._identify_strategy()
+    assert 'skip' not in ab.water_exchange_types
+    ab._define_balancing_parameters()
+    assert ab.static_ratio == 1
+    matrix_data = ab.generate_samples(5)
+    in_sum, out_sum = helper_get_matrix_data_sums_for_test(ab, matrix_data)
+    assert np.allclose(in_sum/out_sum, ab.static_ratio)
+
+
+@pytest.mark.parametrize("code", ["A", "B", "C", "D", "E", "F", "L", "O", "P", "Q", "R", "S", "T"])
+def test_from_exchange_data(data_for_testing, code):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    exchanges = Database("test_db").load()[("test_db", code)]['exchanges']
+    ab = ActivityWaterBalancer.from_exchange_data(("test_db", code), exchanges, wb.water_key_index)
+    matrix_data = ab.generate_samples(5)
+    assert 'water_formula' not in str(exchanges)
+    ab_db = ActivityWaterBalancer(("test_db", code), wb)
+    matrix_data_db = ab_db.generate_samples(5)
+    assert ab.strategy == ab_db.strategy
+    assert ab.static_ratio == ab_db.static_ratio
+    assert ab.static_balance == ab_db.static_balance
+    assert [md[0].shape for md in matrix_data] == [md[0].shape for md in matrix_data_db]
+    assert [sorted(md[1]) for md in matrix_data] == [sorted(md[1]) for md in matrix_data_db]
+    in_sum, out_sum = helper_get_matrix_data_sums_for_test(ab, matrix_data)
+    if ab.strategy == 'default':
+        assert np.allclose(in_sum/out_sum, ab.static_ratio)
+    else:
+        assert np.allclose(out_sum/in_sum, ab.static_ratio)
+
+
+def test_from_exchange_data_no_database_io(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    exchanges = Database("test_db").load()[("test_db", "A")]['exchanges']
+    ab = ActivityWaterBalancer.from_exchange_data(("test_db", "A"), exchanges, wb.water_key_index)
+    ab.generate_samples(5)
+    exc = [exc for exc in get_activity(("test_db", "A")).exchanges()
+           if exc.input.key == ('biosphere', 'Water 1, from nature, in kg')][0]
+    assert exc['formula'] == 'some_good_formula'
+    assert 'temp_formula' not in exc
+    assert 'to_kg_conversion_factor' not in exc
+
+
+@pytest.mark.parametrize("code", ["G", "H", "U"])
+def test_from_exchange_data_set_static(data_for_testing, code):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    exchanges = Database("test_db").load()[("test_db", code)]['exchanges']
+    ab = ActivityWaterBalancer.from_exchange_data(("test_db", code), exchanges, wb.water_key_index)
+    matrix_data = ab.generate_samples(5)
+    matrix_data_db = ActivityWaterBalancer(("test_db", code), wb).generate_samples(5)
+    assert ab.strategy == 'set_static'
+    assert len(matrix_data) == 1
+    assert matrix_data[0][1] == matrix_data_db[0][1]
+    assert np.allclose(matrix_data[0][0], matrix_data_db[0][0])
+
+
+def test_incidence_matrix_static_ratios(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    incidence_matrix = wb.build_incidence_matrix()
+    assert wb.incidence_matrix is incidence_matrix
+    for act_key, strategy, static_ratio in zip(
+            incidence_matrix.act_keys, incidence_matrix.strategies, incidence_matrix.static_ratios):
+        ab = ActivityWaterBalancer(act_key, wb)
+        ab._identify_strategy()
+        assert ab.strategy == strategy
+        if strategy == 'set_static':
+            assert np.isnan(static_ratio)
+        else:
+            ab._define_balancing_parameters()
+            assert np.isclose(static_ratio, ab.static_ratio)
+    assert ('test_db', 'I') not in incidence_matrix.act_keys
+
+
+def test_incidence_matrix_balance(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    incidence_matrix = wb.build_incidence_matrix()
+    samples = incidence_matrix.sample(10, seed=42)
+    unbalanced_ratios = incidence_matrix.get_ratios(samples)
+    balanced = incidence_matrix.balance(samples)
+    balanced_acts = np.array(incidence_matrix.strategies) != 'set_static'
+    ratios = incidence_matrix.get_ratios(balanced)[balanced_acts]
+    assert np.allclose(ratios, incidence_matrix.static_ratios[balanced_acts].reshape(-1, 1))
+    assert not np.allclose(unbalanced_ratios[balanced_acts], ratios)
+    static = incidence_matrix.roles == 'static'
+    assert np.allclose(balanced[static], incidence_matrix.amounts[static].reshape(-1, 1))
+
+
+def test_vectorized_engine(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(iterations=5, engine='vectorized', seed=1)
+    assert wb.matrix_samples.shape == (98, 5)
+    assert len(wb.matrix_indices) == 98
+    wb_params = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb_params.add_samples_for_all_acts(iterations=5)
+    assert sorted(wb.matrix_indices) == sorted(wb_params.matrix_indices)
+    wb_seeded = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb_seeded.add_samples_for_all_acts(iterations=5, engine='vectorized', seed=1)
+    assert np.array_equal(wb.matrix_samples, wb_seeded.matrix_samples)
+    _, dirpath = wb.create_presamples()
+    assert dirpath.is_dir()
+    with pytest.raises(ValueError):
+        wb.add_samples_for_all_acts(iterations=5, engine='unknown')
+
+
+def test_vectorized_engine_memory_limit(data_for_testing, tmp_path):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(iterations=50, engine='vectorized', seed=3)
+    wb_limited = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb_limited.add_samples_for_all_acts(
+        iterations=50, engine='vectorized', seed=3, memory_limit=20000, spill_dirpath=tmp_path
+    )
+    assert wb_limited.samples_filepath.parent == tmp_path
+    assert list(wb_limited.matrix_indices) == list(wb.matrix_indices)
+    assert np.allclose(wb_limited.matrix_samples, wb.matrix_samples)
+
+
+def test_matrix_indices():
+    indices = [
+        (('db', 'b'), ('db', 'a'), 'technosphere'),
+        (('bio', 'w'), ('db', 'a'), 'biosphere'),
+        (('db', 'a'), ('db', 'a'), 'production'),
+    ]
+    matrix_indices = MatrixIndices(indices[:2])
+    matrix_indices.append(indices[2])
+    assert len(matrix_indices) == 3
+    assert list(matrix_indices) == indices
+    assert matrix_indices[1] == indices[1]
+    assert sorted(matrix_indices.keys) == [('bio', 'w'), ('db', 'a'), ('db', 'b')]
+    assert matrix_indices.array['type'].tolist() == [1, 2, 0]
+    other = MatrixIndices()
+    other.extend([(('bio', 'x'), ('db', 'c'))], matrix_type='biosphere')
+    other.extend(matrix_indices)
+    assert list(other) == [(('bio', 'x'), ('db', 'c'), 'biosphere')] + indices
+
+
+def test_matrix_indices_split_samples():
+    indices = [
+        (('db', 'b'), ('db', 'a'), 'technosphere'),
+        (('bio', 'w'), ('db', 'a'), 'biosphere'),
+        (('db', 'a'), ('db', 'a'), 'production'),
+        (('bio', 'v'), ('db', 'b'), 'biosphere'),
+    ]
+    samples = np.arange(8, dtype=np.float64).reshape(4, 2)
+    split = MatrixIndices(indices).split_samples(samples)
+    expected = split_inventory_presamples(samples, indices)
+    assert len(split) == len(expected) == 2
+    for (s, i, label), (s_e, i_e, label_e) in zip(split, expected):
+        assert np.array_equal(s, s_e)
+        assert i == i_e
+        assert label == label_e
+    with pytest.raises(ValueError):
+        MatrixIndices(indices).split_samples(samples[:3])
+
+
+def test_matrix_indices_reorder():
+    indices = [
+        (('db', 'b'), ('db', 'a'), 'technosphere'),
+        (('bio', 'w'), ('db', 'a'), 'biosphere'),
+        (('db', 'a'), ('db', 'a'), 'production'),
+        (('bio', 'v'), ('db', 'b'), 'biosphere'),
+    ]
+    samples = np.arange(8, dtype=np.float64).reshape(4, 2)
+    expected = split_inventory_presamples(samples.copy(), indices)
+    matrix_indices = MatrixIndices(indices)
+    order = np.array([1, 3, 0, 2])
+    matrix_indices.reorder(order, samples)
+    assert list(matrix_indices) == [indices[i] for i in order]
+    assert np.array_equal(samples, np.arange(8, dtype=np.float64).reshape(4, 2)[order])
+    split = matrix_indices.split_samples(samples)
+    for (s, i, label), (s_e, i_e, label_e) in zip(split, expected):
+        # Rows of each matrix are contiguous, so not copied
+        assert np.shares_memory(s, samples)
+        assert np.array_equal(s, s_e)
+        assert i == i_e
+        assert label == label_e
+    with pytest.raises(ValueError):
+        matrix_indices.reorder(order[:3])
+
+
+def test_matrix_indices_sort():
+    indices = [
+        (('db', 'b'), ('db', 'a'), 'technosphere'),
+        (('bio', 'w'), ('db', 'a'), 'biosphere'),
+        (('db', 'a'), ('db', 'a'), 'technosphere'),
+        (('db', 'a'), ('db', 'a'), 'production'),
+        (('bio', 'w'), ('db', 'a'), 'biosphere'),
+    ]
+    samples = np.arange(10, dtype=np.float64).reshape(5, 2)
+    matrix_indices = MatrixIndices(indices)
+    assert matrix_indices.keys == [('db', 'b'), ('bio', 'w'), ('db', 'a')]
+    # Matrix positions of keys, duplicate rows of cells come last
+    assert matrix_indices.sort(samples, positions=[2, 3, 1]) == 3
+    assert list(matrix_indices) == [indices[i] for i in [1, 2, 0, 4, 3]]
+    assert samples.tolist() == [[2, 3], [4, 5], [0, 1], [8, 9], [6, 7]]
+    cells, modified, original = matrix_indices.merge_duplicates(samples, 3)
+    assert list(cells) == [
+        (('bio', 'w'), ('db', 'a'), 'biosphere'),
+        (('db', 'a'), ('db', 'a'), 'production'),
+        (('db', 'b'), ('db', 'a'), 'technosphere'),
+    ]
+    assert samples[:3].tolist() == [[10, 12], [2, 2], [0, 1]]
+    samples[modified] = original
+    assert samples.tolist() == [[2, 3], [4, 5], [0, 1], [8, 9], [6, 7]]
+    with pytest.raises(ValueError):
+        MatrixIndices([indices[i] for i in [1, 4, 0]]).merge_duplicates(samples[:3], 2)
+
+
+def test_sort_samples(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(4, engine='vectorized')
+    cells, cell_matrix = wb.matrix_indices.collapse()
+    expected = dict(zip(cells, cell_matrix @ wb.matrix_samples))
+    with pytest.raises(ValueError):
+        wb.sort_samples(duplicates='raise')
+    assert wb.sort_samples() == 1
+    assert wb.matrix_samples.shape == (97, 4)
+    for index, row in zip(wb.matrix_indices, wb.matrix_samples):
+        assert np.allclose(row, expected[index])
+    array = wb.matrix_indices.array
+    ids = np.array([mapping[key] for key in wb.matrix_indices.keys])
+    positions = list(zip(array['type'] != 2, ids[array['input']], ids[array['output']]))
+    assert positions == sorted(positions)
+    assert wb.sort_samples() == 0
+
+
+def test_pipelined_engine(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(iterations=5, engine='pipelined')
+    assert wb.matrix_samples.shape == (98, 5)
+    wb_params = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb_params.add_samples_for_all_acts(iterations=5)
+    assert sorted(wb.matrix_indices) == sorted(wb_params.matrix_indices)
+    exc = [exc for exc in get_activity(("test_db", "A")).exchanges()
+           if exc.input.key == ('biosphere', 'Water 1, from nature, in kg')][0]
+    assert exc['formula'] == 'some_good_formula'
+    _, dirpath = wb.create_presamples()
+    assert dirpath.is_dir()
+
+
+def test_pipelined_engine_memory_limit(data_for_testing, tmp_path):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(
+        iterations=50, engine='pipelined', memory_limit=20000, spill_dirpath=tmp_path
+    )
+    assert wb.samples_filepath.parent == tmp_path
+    assert wb.matrix_samples.shape == (98, 50)
+    assert len(wb.matrix_indices) == 98
+
+
+def test_pipelined_engine_writer_error(data_for_testing, monkeypatch):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+
+    def store_matrix_data(matrix_data):
+        raise ValueError("Writer failed")
+    monkeypatch.setattr(wb, "_store_matrix_data", store_matrix_data)
+    errors = []
+
+    def run():
+        try:
+            wb._add_pipelined_samples_for_acts([act.key for act in Database("test_db")], 5, queue_size=1)
+        except ValueError as err:
+            errors.append(err)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=20)
+    assert not thread.is_alive()
+    assert [str(err) for err in errors] == ["Writer failed"]
+
+
+def test_schedule_acts(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    plan = wb.plan(5, calibration_size=0)
+    scheduled = wb.schedule_acts()
+    costs = [plan['activities'][ab.act_key]['cost'] for ab in scheduled]
+    assert costs == sorted(costs, reverse=True)
+    assert len(scheduled) == sum(1 for act in plan['activities'].values() if act['strategy'] != 'skip')
+    assert all(plan['activities'][k]['cost'] == 0 for k in plan['activities']
+               if plan['activities'][k]['strategy'] == 'skip')
+
+
+def test_parallel_engine(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(iterations=5, engine='parallel', processes=2)
+    assert wb.matrix_samples.shape == (98, 5)
+    wb_params = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb_params.add_samples_for_all_acts(iterations=5)
+    assert sorted(wb.matrix_indices) == sorted(wb_params.matrix_indices)
+    _, dirpath = wb.create_presamples()
+    assert dirpath.is_dir()
+
+
+def test_parallel_engine_shared_memory(data_for_testing, tmp_path):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db",
+                               biosphere="biosphere", dtype=np.float32)
+    wb.add_samples_for_all_acts(
+        iterations=50, engine='parallel', processes=2, memory_limit=20000, spill_dirpath=tmp_path
+    )
+    assert wb.samples_filepath.parent == tmp_path
+    assert wb.matrix_samples.shape == (98, 50)
+    assert wb.matrix_samples.dtype == np.float32
+    scheduled = [ab.act_key for ab in wb.schedule_acts()]
+    # Rows are in schedule order, whatever the order in which workers finish
+    output_keys = []
+    for index in wb.matrix_indices:
+        if not output_keys or output_keys[-1] != index[1]:
+            output_keys.append(index[1])
+    assert output_keys == scheduled
+    assert np.isfinite(wb.matrix_samples).all()
+
+
+@pytest.mark.parametrize("memory_limit", [20000, 10**6])
+def test_parallel_engine_shared_block_size(data_for_testing, tmp_path, monkeypatch, memory_limit):
+    from multiprocessing import sharedctypes
+    blocks = []
+
+    def raw_array(typecode, size):
+        blocks.append(sharedctypes_raw_array(typecode, size))
+        return blocks[-1]
+
+    sharedctypes_raw_array = sharedctypes.RawArray
+    monkeypatch.setattr(sharedctypes, 'RawArray', raw_array)
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db",
+                               biosphere="biosphere", dtype=np.float32)
+    wb.add_samples_for_all_acts(
+        iterations=50, engine='parallel', processes=2, memory_limit=memory_limit, spill_dirpath=tmp_path
+    )
+    assert all(len(block) <= memory_limit // 2 for block in blocks)
+    assert wb.matrix_samples.shape == (98, 50)
+    assert np.isfinite(wb.matrix_samples).all()
+    # Samples are kept in the shared block, or in the file mapped by workers
+    assert (wb.samples_filepath is not None) == (not blocks)
+    assert list(tmp_path.iterdir()) == ([] if blocks else [wb.samples_filepath])
+    if blocks:
+        assert np.shares_memory(wb.matrix_samples, np.frombuffer(blocks[0], dtype=np.float32))
+    # Existing samples are copied in the shared array of the new samples
+    samples = np.array(wb.matrix_samples)
+    wb.add_samples_for_all_acts(
+        iterations=50, engine='parallel', processes=2, memory_limit=memory_limit, spill_dirpath=tmp_path
+    )
+    assert wb.matrix_samples.shape == (196, 50)
+    assert len(wb.matrix_indices) == 196
+    assert np.array_equal(wb.matrix_samples[:98], samples)
+    if blocks:
+        assert np.shares_memory(wb.matrix_samples, np.frombuffer(blocks[-1], dtype=np.float32))
+
+
+def test_snapshot(data_for_testing, tmp_path):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db",
+                               biosphere="biosphere", dtype=np.float32, unit_conversions={'pint': 0.473})
+    filepath = tmp_path / "snapshot.json"
+    wb.save_snapshot(filepath)
+    loaded = DatabaseWaterBalancer.load_snapshot(filepath)
+    for attr in ['ecoinvent_version', 'database_name', 'biosphere', 'group', 'dtype',
+                 'techno_transfo_keys', 'techno_treat_keys', 'bio_ress_keys',
+                 'bio_emission_keys', 'all_water_keys']:
+        assert getattr(loaded, attr) == getattr(wb, attr)
+    assert loaded.water_key_index.categories == wb.water_key_index.categories
+    assert loaded.water_key_index.unit_conversions['pint'] == 0.473
+    assert loaded.activity_plans == wb.plan(5, calibration_size=0)['activities']
+    loaded.add_samples_for_all_acts(5, memory_limit=10**8)
+    assert loaded.matrix_samples.shape == (98, 5)
+    assert loaded.matrix_samples.dtype == np.float32
+    # Formulas written by the parameters engine modify the database, not its water data
+    with pytest.warns(UserWarning):
+        DatabaseWaterBalancer.load_snapshot(filepath)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        DatabaseWaterBalancer.load_snapshot(filepath, check='fingerprint')
+        DatabaseWaterBalancer.load_snapshot(filepath, check=None)
+
+
+def test_snapshot_outdated(data_for_testing, tmp_path, monkeypatch):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    filepath = tmp_path / "snapshot.json"
+    wb.save_snapshot(filepath)
+    # Databases are not loaded by default
+    with monkeypatch.context() as m:
+        m.setattr(SQLiteBackend, "load", lambda self, *args, **kwargs: pytest.fail("Database loaded"))
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            DatabaseWaterBalancer.load_snapshot(filepath)
+    act = get_activity(('test_db', 'A'))
+    act['name'] = 'modified'
+    act.save()
+    with pytest.warns(UserWarning):
+        DatabaseWaterBalancer.load_snapshot(filepath)
+    # Names are not used by plans
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        DatabaseWaterBalancer.load_snapshot(filepath, check='fingerprint')
+    exc = [exc for exc in act.exchanges() if exc.input.key == ('biosphere', 'Water 1, from nature, in kg')][0]
+    exc['amount'] *= 2
+    exc.save()
+    with pytest.warns(UserWarning):
+        DatabaseWaterBalancer.load_snapshot(filepath, check='fingerprint')
+    with pytest.raises(ValueError):
+        DatabaseWaterBalancer.load_snapshot(filepath, check='hash')
+
+
+def test_verify_balance(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    with pytest.raises(ValueError):
+        wb.verify_balance()
+    wb.add_samples_for_all_acts(iterations=20, engine='vectorized', seed=5)
+    verification = wb.verify_balance(chunk_size=7)
+    assert verification['unverified'] == []
+    assert verification['max_deviation'] < 1e-10
+    assert set(verification['activities']) == set(wb.incidence_matrix.act_keys)
+    # Unbalanced samples are caught
+    wb.matrix_samples = wb.incidence_matrix.sample(20, seed=5)
+    verification = wb.verify_balance()
+    assert verification['max_deviation'] > 1e-3
+    # Invalid samples are not taken for unverifiable balances
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(iterations=20, engine='vectorized', seed=5)
+    wb.matrix_samples[0, 3] = np.nan
+    verification = wb.verify_balance()
+    assert verification['unverified'] == []
+    assert verification['max_deviation'] == np.inf
+    assert np.inf in verification['activities'].values()
+
+
+def test_verify_balance_presamples_package(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(iterations=5)
+    assert wb.verify_balance()['max_deviation'] < 1e-10
+    _, dirpath = wb.create_presamples()
+    verification = wb.verify_balance(dirpath)
+    assert verification['max_deviation'] < 1e-10
+    verified = [k for k, v in verification['activities'].items() if not np.isnan(v)]
+    assert len(verified) + len(verification['unverified']) == len(verification['activities'])
+    # Production and technosphere samples of V are collapsed in the package
+    assert verification['unverified'] == [('test_db', 'V')]
+
+
+@pytest.mark.parametrize("engine", ["parameters", "pipelined", "vectorized"])
+def test_append_samples(data_for_testing, engine):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(4, engine=engine, seed=7)
+    existing = wb.matrix_samples.copy()
+    wb.append_samples_for_all_acts(3, seed=7, engine=engine)
+    assert wb.matrix_samples.shape == (98, 7)
+    assert np.allclose(wb.matrix_samples[:, :4], existing)
+    assert wb.verify_balance()['max_deviation'] < 1e-10
+    # Appended iterations are the block of the random streams after the 4th iteration
+    block = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    block.add_samples_for_all_acts(3, engine=engine, seed=7, start=4)
+    rows = {index: row for row, index in enumerate(block.matrix_indices)}
+    order = [rows[index] for index in wb.matrix_indices]
+    assert np.allclose(wb.matrix_samples[:, 4:], block.matrix_samples[order])
+
+
+def test_append_samples_memory_limit(data_for_testing, tmp_path):
+    wbs = []
+    for memory_limit in [None, 4000]:
+        wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db",
+                                   biosphere="biosphere", dtype=np.float32)
+        wb.add_samples_for_all_acts(4, engine='vectorized', seed=7)
+        wb.append_samples_for_all_acts(6, seed=7, engine='vectorized', memory_limit=memory_limit,
+                                       spill_dirpath=tmp_path)
+        assert wb.matrix_samples.shape == (98, 10)
+        assert wb.matrix_samples.dtype == np.float32
+        wbs.append(wb)
+    assert not isinstance(wbs[0].matrix_samples, np.memmap)
+    # Appended samples are streamed to a single file, new samples are not kept
+    assert isinstance(wbs[1].matrix_samples, np.memmap)
+    assert list(tmp_path.iterdir()) == [wbs[1].samples_filepath]
+    assert np.array_equal(wbs[0].matrix_samples, wbs[1].matrix_samples)
+    assert wbs[1].verify_balance()['max_deviation'] < 1e-4
+
+
+def test_append_samples_to_package(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(4, engine='pipelined', seed=7)
+    _, dirpath = wb.create_presamples(id_="to_append")
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.append_samples_for_all_acts(3, seed=7, dirpath=dirpath, engine='pipelined')
+    # Production and technosphere samples of V are collapsed, as in the package
+    assert wb.matrix_samples.shape == (97, 7)
+    _, dirpath = wb.create_presamples(id_="appended")
+    assert wb.verify_balance(dirpath)['max_deviation'] < 1e-10
+    with pytest.raises(ValueError):
+        DatabaseWaterBalancer(
+            ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere"
+        ).append_samples_for_all_acts(3)
+
+
+def test_recipe(data_for_testing, tmp_path):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    wb.create_recipe(25, filepath=tmp_path / "recipe.npz", seed=5, block_size=10)
+    recipe = WaterSampleRecipe.load(tmp_path / "recipe.npz")
+    assert (recipe.iterations, recipe.seed, recipe.block_size) == (25, 5, 10)
+    samples = recipe.generate()
+    assert samples.shape == (98, 25)
+    assert np.allclose(recipe.generate(7, 13), samples[:, 7:13])
+    assert np.allclose(recipe.generate(20), samples[:, 20:])
+    # Blocks are the samples of the vectorized engine from the same start
+    wb.add_samples_for_all_acts(10, engine='vectorized', seed=5, start=10)
+    assert list(wb.matrix_indices) == list(recipe.indices)
+    assert np.allclose(wb.matrix_samples, samples[:, 10:20])
+    wb.matrix_samples = samples
+    assert wb.verify_balance()['max_deviation'] < 1e-10
+    assert len(recipe.get_matrix_data(0, 3)) == 2
+    with pytest.raises(ValueError):
+        recipe.generate(20, 30)
+
+
+def helper_get_matrix_values(lca, indices):
+    """Return value of LCA matrices at each (input key, output key, matrix type) index"""
+    values = []
+    for input_key, output_key, matrix_type in indices:
+        if matrix_type == 'biosphere':
+            values.append(lca.biosphere_matrix[lca.biosphere_dict[input_key], lca.activity_dict[output_key]])
+        else:
+            values.append(lca.technosphere_matrix[lca.product_dict[input_key], lca.activity_dict[output_key]])
+    return np.array(values)
+
+
+def test_in_memory_presamples_loader(data_for_testing):
+    from bw2calc import LCA, DirectSolvingMonteCarloLCA
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    with pytest.raises(ValueError):
+        wb.get_presamples_loader()
+    wb.add_samples_for_all_acts(4, engine='vectorized', seed=1)
+    demand = {sorted(Database("test_db"))[0]: 1}
+    # Technosphere samples are subtracted from production samples of the same cell
+    signs = np.array([-1 if index[2] == 'technosphere' else 1 for index in wb.matrix_indices])
+    lca = wb.get_presamples_loader().attach(LCA(demand))
+    lca.lci()
+    cells, cell_matrix = wb.matrix_indices.collapse()
+    assert len(cells) == 97
+    # Cells are set to the collapsed samples of the first iteration
+    assert np.allclose(helper_get_matrix_values(lca, cells), np.abs(cell_matrix) @ (signs * wb.matrix_samples[:, 0]))
+    mc = wb.get_presamples_loader().attach(DirectSolvingMonteCarloLCA(demand))
+    for iteration in range(5):
+        next(mc)
+        assert np.allclose(
+            helper_get_matrix_values(mc, cells), np.abs(cell_matrix) @ (signs * wb.matrix_samples[:, iteration % 4])
+        )
+
+
+def test_recipe_presamples_loader(data_for_testing):
+    from bw2calc import LCA
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    recipe = wb.create_recipe(30, seed=3, block_size=10)
+    loader = recipe.get_presamples_loader(seed=2)
+    lca = loader.attach(LCA({sorted(Database("test_db"))[0]: 1}))
+    lca.lci()
+    iteration = loader.package_indexers[0].index
+    # Only the block of the iteration used is generated
+    assert list(recipe._blocks) == [iteration - iteration % 10]
+    cells, cell_matrix = recipe.indices.collapse()
+    signs = np.array([-1 if index[2] == 'technosphere' else 1 for index in recipe.indices])
+    samples = recipe.generate(iteration, iteration + 1)[:, 0]
+    assert np.allclose(helper_get_matrix_values(lca, cells), np.abs(cell_matrix) @ (signs * samples))
+    # Least recently used blocks are dropped from the cache
+    recipe.cache_size = 2
+    recipe.generate(0, 30)
+    assert list(recipe._blocks) == [10, 20]
+    recipe.generate(12, 13)
+    assert list(recipe._blocks) == [20, 10]
+    with pytest.warns(UserWarning):
+        recipe.get_presamples_loader(seed=2)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        recipe.get_presamples_loader()
+
+
+def test_iter_samples(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    results = list(wb.iter_samples(5))
+    assert wb.matrix_samples is None
+    assert len(wb.matrix_indices) == 0
+    strategies = {act_key: strategy for act_key, strategy, _, _ in results}
+    assert strategies[('test_db', 'A')] == 'default'
+    assert strategies[('test_db', 'B')] == 'inverse'
+    assert strategies[('test_db', 'G')] == 'set_static'
+    assert strategies[('test_db', 'I')] == 'skip'
+    for act_key, strategy, samples, indices in results:
+        assert samples.shape == (len(indices), 5)
+        assert all(index[1] == act_key for index in indices)
+        if strategy == 'skip':
+            assert indices == []
+    assert sum(len(indices) for _, _, _, indices in results) == 98
+
+
+def test_multi_database_balancer(data_for_testing):
+    Database("test_db").copy("test_db_2")
+    multi = MultiDatabaseWaterBalancer(ecoinvent_version='test_db', database_names=["test_db", "test_db_2"],
+                                       biosphere="biosphere")
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    for database_name in ["test_db", "test_db_2"]:
+        assert sorted(multi[database_name].bio_ress_keys) == sorted(wb.bio_ress_keys)
+        assert sorted(multi[database_name].bio_emission_keys) == sorted(wb.bio_emission_keys)
+        assert len(multi[database_name].techno_transfo_keys) == len(wb.techno_transfo_keys)
+    assert all(key[0] == "test_db_2" for key in multi["test_db_2"].techno_transfo_keys)
+    multi.add_samples_for_all_acts(5, engine='vectorized')
+    assert multi["test_db_2"].matrix_samples.shape == (98, 5)
+    packages = multi.create_presamples(id_="multi")
+    assert sorted(packages) == ["test_db", "test_db_2"]
+    assert packages["test_db_2"][0] == "multi_test_db_2"
+    id_, dirpath = multi.create_presamples(id_="combined", combined=True)
+    assert multi["test_db"].verify_balance(dirpath)['max_deviation'] < 1e-10
+    assert multi["test_db_2"].verify_balance(dirpath)['max_deviation'] < 1e-10
+
+
+def test_multi_database_balancer_missing_database(data_for_testing):
+    with pytest.raises(ValueError):
+        MultiDatabaseWaterBalancer(ecoinvent_version='test_db', database_names=["test_db", "nope"],
+                                   biosphere="biosphere")
+
+
+@pytest.mark.parametrize("sampling", ["lhs", "sobol", "antithetic"])
+def test_quasi_random_sampling(data_for_testing, sampling):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    ab = ActivityWaterBalancer(('test_db', 'C'), wb)
+    matrix_data = ab.generate_samples(16, sampling=sampling)
+    in_sum, out_sum = helper_get_matrix_data_sums_for_test(ab, matrix_data)
+    assert np.allclose(in_sum/out_sum, ab.static_ratio)
+    exchanges = Database("test_db").load()[("test_db", "C")]['exchanges']
+    ab_data = ActivityWaterBalancer.from_exchange_data(("test_db", "C"), exchanges, wb.water_key_index)
+    matrix_data = ab_data.generate_samples(16, sampling=sampling)
+    in_sum, out_sum = helper_get_matrix_data_sums_for_test(ab_data, matrix_data)
+    assert np.allclose(in_sum/out_sum, ab_data.static_ratio)
+    wb.add_samples_for_all_acts(16, engine='vectorized', sampling=sampling, seed=2)
+    assert wb.verify_balance()['max_deviation'] < 1e-10
+
+
+def test_latin_hypercube_stratification(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    incidence_matrix = wb.build_incidence_matrix()
+    iterations = 20
+    samples = incidence_matrix.sample(iterations, seed=3, sampling='lhs')
+    params = incidence_matrix.params
+    lognormal = np.flatnonzero(params['uncertainty_type'] == 2)
+    assert len(lognormal)
+    from stats_arrays import LognormalUncertainty
+    # Each of the `iterations` equiprobable strata holds exactly one sample
+    percentages = LognormalUncertainty.cdf(params[lognormal], samples[lognormal].copy())
+    strata = np.sort(np.floor(percentages * iterations), axis=1)
+    assert (strata == np.arange(iterations)).all()
+
+
+def test_antithetic_pairs(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    incidence_matrix = wb.build_incidence_matrix()
+    samples = incidence_matrix.sample(10, seed=4, sampling='antithetic')
+    params = incidence_matrix.params
+    lognormal = np.flatnonzero(params['uncertainty_type'] == 2)
+    from stats_arrays import LognormalUncertainty
+    # Cumulative probabilities of paired samples are mirrored within bounds
+    percentages = LognormalUncertainty.cdf(params[lognormal], samples[lognormal].copy())
+    rng = QuasiRandomNumberGenerator(params, 'antithetic')
+    lower, upper = rng.lower[lognormal], rng.upper[lognormal]
+    assert np.allclose(percentages[:, 0::2] + percentages[:, 1::2], (lower + upper).reshape(-1, 1))
+    # Pairs are kept across calls with odd numbers of samples
+    rng = get_random_number_generator(params, 'antithetic', seed=4)
+    chunks = np.concatenate([incidence_matrix._sample(rng, 3), incidence_matrix._sample(rng, 7)], axis=1)
+    assert np.allclose(chunks[rng.ppf_rows], samples[rng.ppf_rows])
+
+
+def test_unknown_sampling(data_for_testing):
+    wb = DatabaseWaterBalancer(ecoinvent_version='test_db', database_name="test_db", biosphere="biosphere")
+    with pytest.raises(ValueError):
+        wb.add_samples_for_all_acts(5, sampling='halton')
+    ab = ActivityWaterBalancer(('test_db', 'A'), wb)
+    with pytest.raises(ValueError):
+        ab.generate_samples(5, sampling='halton')